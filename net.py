@@ -1,6 +1,8 @@
 
+import copy
 import torch
 from torch import nn
+F = torch.nn.functional
 
 from rubiks_cube_states import *
 from rubiks_helpers import *
@@ -9,25 +11,34 @@ def randombatch(n=100):
     'For test reasons'
     return np2t(np.asarray([ state2oh(shuffle(n=30)) for _ in range(n) ]))
 
-def inference_speed(net):
-    'Inference speed of test batch in ms'
-    from time import time
-    batch = randombatch()
-    t0 = time()
-    for _ in range(100):
-        net(batch)
-    t1 = time()
-    
-    batch = randombatch()
-    t2 = time()
-    with torch.no_grad():
-        for _ in range(100):
-            net(batch)
-    t3 = time()
-    return (t1-t0)*10, (t3-t2)*10
+def inference_speed(net, n=100):
+    '''Inference speed of a batch of n states in ms (median), with autograd and with torch.inference_mode.
+    See rubiks_benchmark.py for a sweep over batch sizes and networks.'''
+    from rubiks_benchmark import timeit, make_input
+    p = next(net.parameters())
+    x = make_input(random_states(n, seed=0), 'faces' if isinstance(net, Net_Att) else 'onehot', p.device)
+    ts = timeit(lambda: net(x), p.device)
+    with torch.inference_mode():
+        ts_inf = timeit(lambda: net(x), p.device)
+    return float(1000*np.median(ts)), float(1000*np.median(ts_inf))
     
 
-GPU = True
+def embed_pieces(linear, x):
+    '''Applies the first layer `linear` (oh_len -> n) to pieces states x of shape (b, 20) without building the one hot tensor.
+    As exactly 20 entries of the one hot vector are 1, the layer is the sum of 20 columns of its weight (embedding bag).'''
+    idx = x.long() + torch.arange(0, oh_len, shape_state[1], device=x.device)
+    if torch.is_grad_enabled() and linear.weight.requires_grad:
+        W = linear.weight.t().contiguous()
+    else: # inference: keep the transposed weight until the weight changes
+        key = (linear.weight.data_ptr(), linear.weight._version)
+        cached = getattr(linear, '_embedding', None)
+        if cached is None or cached[0] != key:
+            with torch.no_grad():
+                cached = (key, linear.weight.t().contiguous())
+            linear._embedding = cached
+        W = cached[1]
+    return F.embedding_bag(idx, W, mode='sum') + linear.bias
+
     
 class Net(nn.Module):
     def __init__(self):
@@ -65,31 +76,11 @@ class Net(nn.Module):
             nn.Sigmoid()
         )
         
-        if GPU:
-            self.cuda()
+        self.to(get_device())
         
     def forward(self, x, value=True, policy=True, solvable=False):
-        b = len(x)
-        try:
-            x = x.reshape(b, oh_len)
-        except:
-            print('Couldnt reshape x, x.shape is', x.shape)
-            raise
-        x = self.shared(x)
-        result = tuple()
-        if value:
-            v = 10*self.valuehead(x)
-            result += (v,)
-        if policy:
-            p = self.policyhead(x)
-            result += (p,)
-        if solvable:
-            s = self.solvablehead(x)
-            result += (s,)
-        if len(result) == 1:
-            return result[0]
-        else:
-            return result
+        'x: one hot states of shape (b, 20, 24) or raw pieces states of shape (b, 20) with dtype uint8'
+        return heads(self, trunk(self, x), value=value, policy=policy, solvable=solvable)
         
         
         
@@ -135,39 +126,223 @@ class Net2(nn.Module):
             nn.Sigmoid()
         )
         
-        if GPU:
-            self.cuda()
+        self.to(get_device())
         
     def forward(self, x, value=True, policy=True, solvable=False):
-        b = len(x)
-        try:
-            x = x.reshape(b, oh_len)
-        except:
-            print('Couldnt reshape x, x.shape is', x.shape)
-            raise
-        x = self.shared(x)
-        result = tuple()
-        if value:
-            v = 10*self.valuehead(x)
-            result += (v,)
-        if policy:
-            p = self.policyhead(x)
-            result += (p,)
-        if solvable:
-            s = self.solvablehead(x)
-            result += (s,)
-        if len(result) == 1:
-            return result[0]
-        else:
-            return result
+        'x: one hot states of shape (b, 20, 24) or raw pieces states of shape (b, 20) with dtype uint8'
+        return heads(self, trunk(self, x), value=value, policy=policy, solvable=solvable)
         
         
         
         
         
 
+class Net_Small(nn.Module):
+    '''Small value network for the search on the cpu (oh_len -> 512 -> 256 -> 1), trained by distillation from Net or
+    Net2 (see rubiks_distill.py). Takes one hot states (b, 20, 24) or pieces states (b, 20) with dtype uint8.'''
+    def __init__(self, n1=512, n2=256):
+        super().__init__()
+        
+        self.iter = 1 # number of training iterations
+        self.stats = [] # statistics of cubes solved while learning
+        
+        self.embed = nn.Linear(oh_len, n1) # evaluated as embedding for pieces states, see embed_pieces
+        self.dense = nn.Sequential(
+            nn.ReLU(),
+            nn.Linear(n1, n2),
+            nn.ReLU(),
+            nn.Linear(n2, 1)
+        )
+        
+        self.to(get_device())
+        
+    def forward(self, x, value=True, policy=False, solvable=False):
+        assert value==True and policy==False and solvable==False, 'Only value supported!'
+        if x.dtype == torch.uint8:
+            x = embed_pieces(self.embed, x)
+        else:
+            x = self.embed(x.reshape(len(x), oh_len))
+        return 10*self.dense(x)
+
+
+
+# Incremental evaluation of child states (like the accumulators in NNUE chess engines). The first layer of Net and Net2
+# is a sum of 20 weight columns, one per piece. A move changes only 8 pieces, so the first layer of a child is the one of
+# the parent plus 8 difference columns D[m, k, v] = W[:, new column] - W[:, old column], where k runs over the 8 positions
+# changed by the move m and v is the value of the parent at that position.
+
+def _acc_tables(net):
+    '''Difference columns (12*8*24 rows of length n) and changed positions (12, 8) of the first layer of net.
+    The tables are built once and rebuilt when the weights change (the version counter of the tensor is increased by
+    optimizer steps and load_state_dict). They are never written afterwards and are normal tensors (also if built in
+    torch.inference_mode), so they can be shared by all threads and modes.'''
+    linear = net.shared[0]
+    key = (linear.weight.data_ptr(), linear.weight._version)
+    cached = getattr(net, '_acc_cache', None)
+    if cached is None or cached[0] != key:
+        from rubiks_cube_pieces import _tables as _move_tables
+        pos, ori = _move_tables()
+        slots = np.array([ np.flatnonzero(pos[m] != np.arange(20)) for m in range(12) ]) # (12, 8)
+        v = np.arange(24)
+        old, new = np.empty((12, 8, 24), dtype='int64'), np.empty((12, 8, 24), dtype='int64')
+        for m in range(12):
+            for k, n in enumerate(slots[m]):
+                N = 8 if n<8 else 12
+                old[m, k] = 24*n + v
+                new[m, k] = 24*pos[m, n] + v%N + N*ori[m, n, np.minimum(v//N, 2)]
+        with torch.inference_mode(False), torch.no_grad():
+            W = linear.weight.t()
+            old, new = torch.from_numpy(old).to(W.device), torch.from_numpy(new).to(W.device)
+            D = W[new.reshape(-1)] - W[old.reshape(-1)]
+            cached = (key, D, torch.from_numpy(slots).to(W.device))
+        net._acc_cache = cached
+    _, D, slots = cached
+    return D, slots
+
+
+def trunk(net, x):
+    '''Shared features of Net or Net2 (output of net.shared) for one hot states x (b, 20, 24) or pieces states (b, 20, uint8).
+    Together with `heads` this allows to evaluate several heads on the same states without recomputing the trunk.'''
+    b = len(x)
+    if x.dtype == torch.uint8:
+        return net.shared[1:](embed_pieces(net.shared[0], x))
+    try:
+        x = x.reshape(b, oh_len)
+    except:
+        print('Couldnt reshape x, x.shape is', x.shape)
+        raise
+    return net.shared(x)
+
+
+def heads(net, h, value=True, policy=True, solvable=False):
+    '''Evaluates the selected heads on the trunk features h = trunk(net, x). Returns the same as net.forward,
+    i. e. a single tensor for one head and a tuple (value, policy, solvable) for several heads.'''
+    result = tuple()
+    if value:
+        result += (10*net.valuehead(h),)
+    if policy:
+        result += (net.policyhead(h),)
+    if solvable:
+        result += (net.solvablehead(h),)
+    if len(result) == 1:
+        return result[0]
+    else:
+        return result
+
+
+def accumulate(net, x):
+    'First layer of net (before the activation) for pieces states x of shape (b, 20) with dtype uint8'
+    return embed_pieces(net.shared[0], x)
+
+
+def forward_acc(net, acc, value=True, policy=True, solvable=False):
+    'Same as net.forward, but starting from the accumulators acc = accumulate(net, x)'
+    return heads(net, net.shared[1:](acc), value=value, policy=policy, solvable=solvable)
+
+
+def expand(net, acc, x, ms=None, value=True, policy=False, solvable=False):
+    '''Evaluates the children of the states x (b, 20, uint8) with accumulators acc (b, n).
+    ms: move indices (b, k), if None all 12 moves are used. Returns the accumulators of the children (b, k, n)
+    and the outputs of the heads for the children with leading dimensions (b, k), as in net.forward.
+    The children themselves (e. g. apply_all_moves) are not needed, only the parent states.'''
+    b = len(x)
+    D, slots = _acc_tables(net)
+    if ms is None:
+        ms = torch.arange(12, device=x.device).expand(b, 12)
+    else:
+        ms = torch.as_tensor(ms, dtype=torch.int64, device=x.device)
+    k = ms.shape[1]
+    vals = torch.gather(x.long()[:,None,:].expand(b, k, 20), 2, slots[ms]) # values of the changed positions, (b, k, 8)
+    idx = (ms[:,:,None]*8 + torch.arange(8, device=x.device))*24 + vals
+    acc = acc[:,None,:] + F.embedding_bag(idx.reshape(b*k, 8), D, mode='sum').reshape(b, k, -1)
+    result = forward_acc(net, acc.reshape(b*k, -1), value=value, policy=policy, solvable=solvable)
+    if isinstance(result, tuple):
+        result = tuple( r.reshape(b, k, *r.shape[1:]) for r in result )
+    else:
+        result = result.reshape(b, k, *result.shape[1:])
+    return acc, result
+
+
+from collections import OrderedDict
+
+class AccumulatorCache:
+    '''Stores the accumulators of the open nodes of a search, so that their children can be evaluated by `expand`.
+    The key of a node is state.tobytes() or given by the caller (e. g. the node index in the open list of the solver).
+    With 4096 floats (16 kB) per node the cache is bounded by maxsize (default 8192 nodes, i. e. 128 MB for Net and
+    Net2), which covers the nodes that are expanded soon. The oldest entries are dropped and recomputed by `accumulate`
+    when they are needed.'''
+    def __init__(self, net, maxsize=8192):
+        self.net = net
+        self.maxsize = maxsize
+        self.cache = OrderedDict()
+    def put(self, states, acc, keys=None):
+        'states: (b, 20) numpy array, acc: (b, n) tensor, keys: b keys (default: state.tobytes())'
+        if keys is None:
+            keys = [ s.tobytes() for s in states ]
+        for k, a in zip(keys, acc):
+            self.cache[k] = a
+        while len(self.cache) > self.maxsize:
+            self.cache.popitem(last=False)
+    def pop(self, states, keys=None):
+        'Returns the accumulators (b, n) of the states and removes them, missing ones are recomputed'
+        if keys is None:
+            keys = [ s.tobytes() for s in states ]
+        accs = [ self.cache.pop(k, None) for k in keys ]
+        missing = [ i for i, a in enumerate(accs) if a is None ]
+        if missing:
+            with torch.no_grad():
+                new = accumulate(self.net, pieces2torch(states[missing]))
+            for i, a in zip(missing, new):
+                accs[i] = a
+        return torch.stack(accs)
+    def remap(self, f):
+        'Replaces each key k by f(k) (e. g. after the nodes were renumbered), entries with f(k) None are removed'
+        cache = OrderedDict()
+        for k, a in self.cache.items():
+            k = f(k)
+            if k is not None:
+                cache[k] = a
+        self.cache = cache
+    def __len__(self):
+        return len(self.cache)
+
+
+
+class TrunkCache:
+    '''Trunk features (see `trunk`) of states which are evaluated repeatedly, e. g. within a search first for the value
+    and later for the policy (key: state.tobytes()). Holds at most maxsize states (2048 floats each), the least recently
+    used are dropped. The cache is cleared automatically when the weights of the trunk change.'''
+    def __init__(self, net, maxsize=100000):
+        self.net = net
+        self.maxsize = maxsize
+        self.cache = OrderedDict()
+        self.version = None
+    def __call__(self, states):
+        'Trunk features (b, 2048) of the pieces states (b, 20), only the states not in the cache are evaluated'
+        version = tuple( p._version for p in self.net.shared.parameters() )
+        if version != self.version:
+            self.cache.clear()
+            self.version = version
+        keys = [ s.tobytes() for s in states ]
+        missing = [ i for i, k in enumerate(keys) if k not in self.cache ]
+        if missing:
+            with torch.no_grad(): # the cache is for the search, the rows must not keep the autograd graph alive
+                new = trunk(self.net, pieces2torch(states[missing]))
+            for i, h in zip(missing, new):
+                self.cache[keys[i]] = h
+        hs = []
+        for k in keys:
+            self.cache.move_to_end(k)
+            hs.append(self.cache[k])
+        while len(self.cache) > self.maxsize:
+            self.cache.popitem(last=False)
+        return torch.stack(hs)
+    def __len__(self):
+        return len(self.cache)
+
+
+
 relu = nn.functional.relu
-F = torch.nn.functional
 
 class AttentionLayer(nn.Module):
     def __init__(self, n):
@@ -239,8 +414,7 @@ class Net_Att(nn.Module):
         
         self.dense2 = nn.Linear(512, 1)
         
-        if GPU:
-            self.cuda()
+        self.to(get_device())
         
         
     def forward(self, x, value=True, policy=False, solvable=False):
@@ -264,4 +438,144 @@ class Net_Att(nn.Module):
         
         return v
 
-    
\ No newline at end of file
+    
+
+
+class AttentionLayer_Inference(nn.Module):
+    '''AttentionLayer of a trained net for inference (with the running statistics of the batch norms). Works on the layout (b, hw, c) instead of (b, c, hw).
+    bn1 becomes a constant affine map (it acts on the residual stream before a relu, so it can not be folded), bn2 is
+    folded into dense1 and the attention is computed by scaled_dot_product_attention. The attention map is only
+    computed and stored in last_beta if debug is set.'''
+    def __init__(self, al, debug=False):
+        super().__init__()
+        self.debug = debug
+        c = al.dense1.in_features
+        self.c = c
+        with torch.no_grad():
+            s1 = al.bn1.weight / torch.sqrt(al.bn1.running_var + al.bn1.eps)
+            self.register_buffer('scale1', s1.clone())
+            self.register_buffer('shift1', (al.bn1.bias - al.bn1.running_mean*s1).clone())
+            self.qkv = nn.Linear(c, 2*c//8 + c)
+            self.qkv.weight.copy_(al.qkv.weight[:,:,0])
+            self.qkv.bias.copy_(al.qkv.bias)
+            s2 = al.bn2.weight / torch.sqrt(al.bn2.running_var + al.bn2.eps)
+            t2 = al.bn2.bias - al.bn2.running_mean*s2
+            self.dense1 = nn.Linear(c, c)
+            self.dense1.weight.copy_(al.dense1.weight * s2)
+            self.dense1.bias.copy_(al.dense1.bias + al.dense1.weight @ t2)
+            self.dense2 = copy.deepcopy(al.dense2)
+
+    def forward(self, x):
+        c = self.c
+        q, k, v = torch.split(self.qkv(relu(x*self.scale1 + self.shift1)), [c//8, c//8, c], dim=2)
+        # In AttentionLayer the softmax runs over the first index of q^T k, i. e. position j attends with its k_j to all q_i
+        x = x + F.scaled_dot_product_attention(k, q, v)
+        if self.debug:
+            self.last_beta = F.softmax(torch.bmm(q, k.transpose(1, 2)) / np.sqrt(c//8), dim=1)
+        return x + self.dense2(relu(self.dense1(x)))
+
+
+class Net_Att_Inference(nn.Module):
+    '''Inference variant of a trained Net_Att (same outputs up to rounding, no training). Takes the one hot faces
+    (b, 6, 6, 3, 3) like Net_Att or pieces states (b, 20) with dtype uint8. For pieces the first convolution is a sum of
+    one precomputed embedding per piece (the stickers of the piece), as for Net in embed_pieces.
+    debug: store the attention maps in last_beta of the attention layers'''
+    def __init__(self, net, debug=False):
+        super().__init__()
+        n = net.n
+        self.n = n
+        self.iter = net.iter
+        self.stats = net.stats
+        with torch.no_grad():
+            W = net.embed_c.weight[:,:,0] # (n, 54), input channel = color*9 + sticker on the side
+            const = net.embed_c.bias[:,None] + net.embed_p[0] # (n, 6)
+            self.register_buffer('embed_faces', W.t().contiguous().clone())
+            self.register_buffer('embed_const', const.t().contiguous().clone()) # (6, n)
+            # embedding of the pieces: piece n with value v colors the stickers with flat faces index f = 9*side + sticker
+            from rubiks_cube import _corner_stickers, _corner_colors, _edge_stickers, _edge_colors, _center_stickers, _center_colors
+            E = torch.zeros(20, 24, 6, n)
+            for p in range(20):
+                for v in range(24):
+                    if p < 8:
+                        stickers, colors = _corner_stickers[p], _corner_colors[p, v]
+                    else:
+                        stickers, colors = _edge_stickers[p-8], _edge_colors[v]
+                    for f, col in zip(stickers, colors):
+                        E[p, v, f//9] += W[:, 9*col + f%9].cpu()
+            for f, col in zip(_center_stickers, _center_colors):
+                const[:, f//9] += W[:, 9*col + f%9]
+            self.register_buffer('embed_pieces', E.reshape(20*24, 6*n).to(W.device))
+            self.register_buffer('embed_pieces_const', const.t().contiguous().clone())
+            self.register_buffer('offsets', torch.arange(0, 20*24, 24, device=W.device))
+            self.al1 = AttentionLayer_Inference(net.al1, debug)
+            self.al2 = AttentionLayer_Inference(net.al2, debug)
+            # dense1 takes the channels as (c, side) in Net_Att, here (side, c)
+            self.dense1 = nn.Linear(n*6, 512)
+            self.dense1.weight.copy_(net.dense1.weight.reshape(512, n, 6).permute(0, 2, 1).reshape(512, 6*n))
+            self.dense1.bias.copy_(net.dense1.bias)
+            self.dense2 = copy.deepcopy(net.dense2)
+        for p in self.parameters():
+            p.requires_grad_(False)
+        self.eval()
+
+    def forward(self, x, value=True, policy=False, solvable=False):
+        assert value==True and policy==False and solvable==False, 'Only value supported!'
+        b = len(x)
+        if x.dtype == torch.uint8:
+            x = F.embedding_bag(x.long() + self.offsets, self.embed_pieces, mode='sum').reshape(b, 6, self.n)
+            x = x + self.embed_pieces_const
+        else:
+            x = x.permute(0, 2, 1, 3, 4).reshape(b, 6, 6*9) # b c s h w --> b s (c h w)
+            x = x @ self.embed_faces + self.embed_const
+        x = self.al1(x)
+        x = self.al2(x)
+        x = relu(self.dense1(x.reshape(b, 6*self.n)))
+        return 10*self.dense2(x)
+
+
+
+# Inference on the cpu (solve boxes without gpu). The networks are loaded once per process and prepared by cpu_inference,
+# the evaluation runs in torch.inference_mode via predict.
+
+_loaded_nets = dict()
+
+def cpu_inference(net, quantize=False, threads=None):
+    '''Prepares net for inference on the cpu: eval mode, no gradients and optionally dynamic int8 quantization of the
+    Linear layers. The first layer of Net, Net2 and Net_Small stays in float32, as it is used as embedding (see embed_pieces).
+    threads: number of torch threads (default: torch's choice)'''
+    if threads is not None:
+        torch.set_num_threads(threads)
+    net = net.cpu().eval()
+    for p in net.parameters():
+        p.requires_grad_(False)
+    if quantize:
+        from torch.ao.quantization import quantize_dynamic, default_dynamic_qconfig
+        spec = { name: default_dynamic_qconfig for name, mod in net.named_modules()
+                 if isinstance(mod, nn.Linear) and name not in ('shared.0', 'embed') }
+        net = quantize_dynamic(net, spec, dtype=torch.qint8)
+    return net
+
+
+def load_net(fn, cls=Net, quantize=False, threads=None):
+    '''Loads the weights of file fn (saved by torch.save(net.state_dict(), fn)) into a net of class cls for inference on
+    the cpu. Every combination of arguments is loaded once per process and then taken from a cache.'''
+    key = (os.path.abspath(fn), cls.__name__, quantize)
+    if key not in _loaded_nets:
+        net = cls().cpu()
+        net.load_state_dict(torch.load(fn, map_location='cpu'))
+        _loaded_nets[key] = cpu_inference(net, quantize=quantize)
+    if threads is not None:
+        torch.set_num_threads(threads)
+    return _loaded_nets[key]
+
+
+def predict(net, states, value=True, policy=False, solvable=False):
+    '''Evaluates net on pieces states (b, 20) in torch.inference_mode and returns numpy arrays'''
+    p = next(net.parameters(), None)
+    x = torch.from_numpy(np.ascontiguousarray(states, dtype='uint8'))
+    x = x.to(p.device if p is not None else 'cpu')
+    with torch.inference_mode():
+        result = net(x, value=value, policy=policy, solvable=solvable)
+    if isinstance(result, tuple):
+        return tuple( t2np(r) for r in result )
+    return t2np(result)
@@ -7,6 +7,7 @@ import os, gzip, pickle
 import numpy as np
 
 from rubiks_helpers import *
+from rubiks_cube_faces import *
 
 
 nval = 1500
@@ -117,17 +118,14 @@ class BatchGen:
         mb = self.minibatches.pop()
         size = self.mbsize
         xs = np.zeros((size, 6, 6, 3, 3))
-        zs = np.zeros((size, 12, 6, 6, 3, 3))
+        faces = np.zeros((size, 6, 3, 3), dtype='uint8')
         for i, k in enumerate(mb):
             x = self.collection[k]
             # encode x
             xs[i] = x
-            # encode z
-            faces = oh2faces(x)
-            for r in range(12): # this loop goes through all moves which can be done on the cube
-                faces2 = apply(faces, r)
-                oh = faces2oh(faces2)
-                zs[i,r] = oh
+            faces[i] = oh2faces(x)
+        # encode z: all moves which can be done on the cubes
+        zs = Bfaces2oh(apply_all_moves(faces).reshape(-1, 6, 3, 3)).reshape(size, 12, 6, 6, 3, 3)
         return xs, zs
         
         
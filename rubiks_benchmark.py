@@ -0,0 +1,106 @@
+'''
+Inference benchmark of the networks. Sweeps over batch sizes, networks, input formats and inference variants and
+reports states/s and latency percentiles as JSON, e. g. to choose the batch size of the solver.
+    python rubiks_benchmark.py --out benchmark.json
+'''
+
+import copy
+import json
+from time import perf_counter
+
+import torch
+from net import *
+from rubiks_cube_faces import pieces2faces
+
+batchsizes = (1, 4, 16, 64, 256, 1024, 4096, 16384)
+networks = ('Net', 'Net2', 'Net_Att')
+variants = ('grad', 'no_grad', 'int8') # autograd enabled, torch.inference_mode, inference_mode with int8 linear layers
+inputs = { 'Net': ('onehot', 'pieces'), 'Net2': ('onehot', 'pieces'), 'Net_Att': ('faces',) }
+
+
+def make_input(states, kind, device):
+    '''Input tensor of the states (b, 20) in the format kind: 'pieces' (uint8 indices), 'onehot' (b, 20, 24) or
+    'faces' (one hot faces (b, 6, 6, 3, 3) for Net_Att)'''
+    if kind == 'pieces':
+        return torch.from_numpy(states).to(device)
+    if kind == 'onehot':
+        return F.one_hot(torch.from_numpy(states).long(), 24).float().to(device)
+    faces = torch.from_numpy(pieces2faces(states)).long()
+    return F.one_hot(faces, 6).permute(0, 4, 1, 2, 3).float().to(device)
+
+
+def _sync(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def timeit(f, device, warmup=2, min_time=1., min_repeats=5, max_repeats=200):
+    '''Latencies in s of the calls of f, after `warmup` calls. Repeats until min_time has passed (and at least
+    min_repeats times)'''
+    for _ in range(warmup):
+        f()
+    _sync(device)
+    ts = []
+    t_start = perf_counter()
+    while len(ts) < max_repeats and (len(ts) < min_repeats or perf_counter() - t_start < min_time):
+        t0 = perf_counter()
+        f()
+        _sync(device)
+        ts.append(perf_counter() - t0)
+    return np.array(ts)
+
+
+def benchmark(nets=networks, batchsizes=batchsizes, variants=variants, device='cpu', threads=None, min_time=1.,
+              verbose=True, fn=None):
+    '''Benchmarks the forward pass (value head) of the nets. Returns a list of dictionaries, one per configuration,
+    and writes them as JSON to fn if given. int8 is only measured on the cpu.'''
+    device = torch.device(device)
+    if threads is not None:
+        torch.set_num_threads(threads)
+    states = random_states(max(batchsizes), seed=0)
+    results = []
+    for name in nets:
+        net = globals()[name]().to(device).eval()
+        for variant in variants:
+            if variant == 'int8':
+                if device.type != 'cpu':
+                    continue
+                model = cpu_inference(copy.deepcopy(net), quantize=True)
+            else:
+                model = net
+            for kind in inputs[name]:
+                for b in batchsizes:
+                    x = make_input(states[:b], kind, device)
+                    if variant == 'grad':
+                        f = lambda: model(x, value=True, policy=False)
+                    else:
+                        def f():
+                            with torch.inference_mode():
+                                return model(x, value=True, policy=False)
+                    ts = timeit(f, device, min_time=min_time)
+                    res = dict(net=name, variant=variant, input=kind, batchsize=b, device=str(device),
+                               threads=torch.get_num_threads(), repeats=len(ts),
+                               states_per_s=b / ts.mean(),
+                               latency_ms={ f'p{q}': 1000*np.percentile(ts, q) for q in (50, 90, 99) })
+                    results.append(res)
+                    if verbose:
+                        print(f'{name:8s}{variant:8s}{kind:7s}b={b:<6d}{res["states_per_s"]:10.0f} states/s, '
+                              f'p50 {res["latency_ms"]["p50"]:.2f} ms, p99 {res["latency_ms"]["p99"]:.2f} ms')
+    if fn is not None:
+        with open(fn, 'w') as f:
+            json.dump(results, f, indent=1)
+    return results
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Inference benchmark of the networks')
+    parser.add_argument('--out', default='benchmark.json')
+    parser.add_argument('--nets', nargs='+', default=networks)
+    parser.add_argument('--batchsizes', nargs='+', type=int, default=batchsizes)
+    parser.add_argument('--variants', nargs='+', default=variants)
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--min-time', type=float, default=1.)
+    args = parser.parse_args()
+    benchmark(args.nets, args.batchsizes, args.variants, args.device, args.threads, args.min_time, fn=args.out)
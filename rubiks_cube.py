@@ -36,7 +36,37 @@ colors_rev = { c: k for k, c in enumerate(colors) }
 
 colcode = [ Back.RED, Back.MAGENTA, Back.GREEN, Back.BLUE, Back.WHITE, Back.YELLOW ] # for printing
 
-_dict_piecesorientation = dict() # dictionary for the orientation of corner pieces (i. e. how are the colors of the corner pieces arranged?)
+# Transformation and layer of each move
+_transforms = {
+    'F': (rotx, cond_f), 'f': (rotxi, cond_f), 'B': (rotxi, cond_b), 'b': (rotx, cond_b),
+    'R': (roty, cond_r), 'r': (rotyi, cond_r), 'L': (rotyi, cond_l), 'l': (roty, cond_l),
+    'U': (rotz, cond_u), 'u': (rotzi, cond_u), 'D': (rotzi, cond_d), 'd': (rotz, cond_d),
+    'X': (rotx, cond_all), 'x': (rotxi, cond_all),
+    'Y': (roty, cond_all), 'y': (rotyi, cond_all),
+    'Z': (rotz, cond_all), 'z': (rotzi, cond_all),
+    'i': (mirrx, cond_all), 'j': (mirry, cond_all), 'k': (mirrz, cond_all),
+}
+
+_permutations_cache = dict() # permutation tables for each cube size N
+
+def _permutations(N, xyzf_inds):
+    '''Returns a dictionary which maps each move to a flat sticker permutation of the (N,N,N,3) cube array,
+    i. e. cube.reshape(-1)[perm] is the cube after the move. Compiled once per N.'''
+    if N in _permutations_cache:
+        return _permutations_cache[N]
+    off = (N-1)/2
+    ind = lambda x, y, z, fx, fy, fz: ((int(x+off)*N + int(y+off))*N + int(z+off))*3 + int(np.argmax(np.abs([fx, fy, fz])))
+    
+    perms = dict()
+    for m, (transform, condition) in _transforms.items():
+        perm = np.arange(N*N*N*3)
+        for (x, y, z, fx, fy, fz) in xyzf_inds:
+            if condition(x, y, z):
+                perm[ind(x, y, z, fx, fy, fz)] = ind(*transform(x, y, z), *transform(fx, fy, fz))
+        perms[m] = perm
+    _permutations_cache[N] = perms
+    return perms
+
 
 def inverse_moves(moves):
     'Returns the inverse of the moves'
@@ -63,6 +93,7 @@ class RubiksCube():
                         self._xyzf_inds.append((x, y, z, 0, y, 0))
                     if abs(z)!=0:
                         self._xyzf_inds.append((x, y, z, 0, 0, z))
+        self._perms = _permutations(N, self._xyzf_inds)
         self.reset()
         self.draw = self.draw_colored
         
@@ -480,53 +511,17 @@ class RubiksCube():
                 self.rotate(m)
             return
         
-        # if one move
-        if move == 'F':
-            self._dotransform(rotx, cond_f)
-        if move == 'f':
-            self._dotransform(rotxi, cond_f)
-        if move == 'B':
-            self._dotransform(rotxi, cond_b)
-        if move == 'b':
-            self._dotransform(rotx, cond_b)
-
-        if move == 'R':
-            self._dotransform(roty, cond_r)
-        if move == 'r':
-            self._dotransform(rotyi, cond_r)
-        if move == 'L':
-            self._dotransform(rotyi, cond_l)
-        if move == 'l':
-            self._dotransform(roty, cond_l)
-
-        if move == 'U':
-            self._dotransform(rotz, cond_u)
-        if move == 'u':
-            self._dotransform(rotzi, cond_u)
-        if move == 'D':
-            self._dotransform(rotzi, cond_d)
-        if move == 'd':
-            self._dotransform(rotz, cond_d)
+        # if one move: gather the stickers by the precompiled permutation (unknown moves are ignored)
+        perm = self._perms.get(move)
+        if perm is not None:
+            self.cube = self.cube.reshape(-1)[perm].reshape(self.cube.shape)
             
-        if move == 'X':
-            self._dotransform(rotx, cond_all)
-        if move == 'x':
-            self._dotransform(rotxi, cond_all)
-        if move == 'Y':
-            self._dotransform(roty, cond_all)
-        if move == 'y':
-            self._dotransform(rotyi, cond_all)
-        if move == 'Z':
-            self._dotransform(rotz, cond_all)
-        if move == 'z':
-            self._dotransform(rotzi, cond_all)
             
-        if move == 'i':
-            self._dotransform(mirrx, cond_all)
-        if move == 'j':
-            self._dotransform(mirry, cond_all)
-        if move == 'k':
-            self._dotransform(mirrz, cond_all)
+    def rotate_slow(self, move):
+        '''Reference implementation of `rotate` which transforms the cube sticker by sticker'''
+        for m in move:
+            if m in _transforms:
+                self._dotransform(*_transforms[m])
             
             
     def shuffle(self, n=15, verbose=0):
@@ -601,115 +596,203 @@ class RubiksCube():
         
         
     def getpieces(self):
+        '''Returns the 20 movable pieces, i. e. an array of 8 corners (8*orientation + colors) and 12 edges (12*orientation + colors)'''
         assert self.N == 3
-        global _dict_piecesorientation
-        
-        pieces = -99*np.ones(20, dtype='uint8')
-        n = 0
-        
-        # Corner pieces
-        # Since opposite sides are 0,1; 2,3; 4,5, the corner pieces' colors is a triplet of these, e.g. (0,3,4)
-        colors_corners = [ (c1, c2, c3) for c1 in [0,1] for c2 in [2,3] for c3 in [4,5] ]
-        pos_corners = [ (i, j, k) for i in [-1, 1] for j in [-1, 1] for k in [-1, 1] ]
-        for i, j, k in pos_corners:
-            for m, (c1, c2, c3) in enumerate(colors_corners):
-                for f in range(3):
-                    if self.cube[i+1,j+1,k+1,f] not in [c1, c2, c3]:
-                        break  # not the piece we were looking for
-                else:  # --> the piece matches the colors
-                    colors = m # this encodes the specific piece, i. e. the pieces color, into 0..7.
-                    orientation = np.argmin(self.cube[i+1,j+1,k+1,:]) # orientation of the piece, its in 0..2
-                    pieces[n] = (8*orientation + colors)
-                    n += 1
-                    
-                    # save the colors of this piece in the dictionary (since we save only the orientation which leaves two colors unknown when restoring)
-                    # needed only once! but doesnt harm to repeat
-                    piececolors = self.cube[i+1,j+1,k+1,:].copy()
-                    ax0 = np.argmin(piececolors) # axis for c1
-                    piececolors[ax0] = 9999
-                    ax1 = np.argmin(piececolors) # axis for c2
-                    piececolors[ax1] = 9999
-                    ax2 = np.argmin(piececolors) # axis for c3
-                    
-                    M = np.zeros((3,3))
-                    M[0, ax0] = [i,j,k][ax0]
-                    M[1, ax1] = [i,j,k][ax1] 
-                    M[2, ax2] = [i,j,k][ax2]
-                    sign = np.linalg.det(M)
-                    
-                    if (c1,c2,c3) in _dict_piecesorientation.keys():
-                        assert _dict_piecesorientation[c1,c2,c3] == sign, f'Orientation inconsistency at corner pieces! c1,c2,c3 = {c1,c2,c3}'
-                    else:
-                        _dict_piecesorientation[c1,c2,c3] = sign
-                    
-
-        # Edge pieces
-        # the edge pieces' colors are duplets which are not
-        colors_edges = [ (c1, c2) for c1 in range(6) for c2 in range(6) if c1 < c2 and c1//2 != c2//2 ]
-        pos_edges = [ (i, j, k) for i in range(3) for j in range(3) for k in range(3) if abs(i-1)+abs(j-1)+abs(k-1)==2 ]
-        for i, j, k in pos_edges:
-            for m, (c1, c2) in enumerate(colors_edges):
-                for f in range(3):
-                    if [i,j,k][f] == 1:
-                        continue
-                    if self.cube[i,j,k,f] not in [c1, c2]:
-                        break
-                else: # --> the piece matches the colors
-                    colors = m
-                    left_dim = np.argmin([abs(i-1), abs(j-1), abs(k-1)])
-                    orientation = np.argmin(self.cube[i,j,k,:]) # in 0..2
-                    if orientation > left_dim: orientation += -1 # in 0..1
-                    pieces[n] = 12*orientation + colors
-                    n += 1
-        return pieces
-
-    
+        return faces2pieces(self.getfaces())
     
-                    
     def frompieces(self, pieces):
+        '''Get a cube from the pieces (the center pieces are in standard orientation)'''
         assert self.N == 3
+        self.fromfaces(pieces2faces(pieces))
+                          
+
+# Index tables of the 3x3x3 cube: position of the faces stickers in the flattened cube array, and the faces stickers of the pieces
+_cube_inds = RubiksCube(3)
+_cube_inds.cube = np.arange(3*3*3*3, dtype='uint8').reshape(3, 3, 3, 3)
+_faces_inds = _cube_inds.getfaces().astype('int').reshape(-1) # faces.flatten() == cube.flatten()[_faces_inds]
+del _cube_inds
+
+def _sticker(i, j, k, f):
+    'Index in the flattened faces of the sticker at cube position i, j, k (in 0..2) looking in dimension f'
+    return list(_faces_inds).index(((i*3 + j)*3 + k)*3 + f)
+
+# Pieces: corners and edges in the order of the pieces format, the corners' stickers looking in x, y, z direction and the edges' stickers in ascending dimension.
+# Since opposite sides are 0,1; 2,3; 4,5, the corner pieces' colors is a triplet of these, e.g. (0,3,4), and the edge pieces' colors are duplets
+colors_corners = [ (c1, c2, c3) for c1 in [0,1] for c2 in [2,3] for c3 in [4,5] ]
+pos_corners = [ (i, j, k) for i in [-1, 1] for j in [-1, 1] for k in [-1, 1] ]
+colors_edges = [ (c1, c2) for c1 in range(6) for c2 in range(6) if c1 < c2 and c1//2 != c2//2 ]
+pos_edges = [ (i, j, k) for i in range(3) for j in range(3) for k in range(3) if abs(i-1)+abs(j-1)+abs(k-1)==2 ]
+
+_corner_stickers = np.array([ [ _sticker(i+1, j+1, k+1, f) for f in range(3) ] for i, j, k in pos_corners ])
+_edge_stickers = np.array([ [ _sticker(i, j, k, f) for f in range(3) if [i,j,k][f] != 1 ] for i, j, k in pos_edges ])
+_center_stickers = np.array([ 9*k + 4 for k in range(6) ])
+_center_colors = RubiksCube(3).getfaces()[:, 1, 1]
+
+_edge_ids = 99*np.ones((6, 6), dtype='uint8') # color pair (lower, higher) -> number of the edge piece
+for _m, (_c1, _c2) in enumerate(colors_edges):
+    _edge_ids[_c1, _c2] = _m
+
+# Colors of the stickers of a corner at position n with value 8*orientation + colors. The lowest color c1 looks in dimension `orientation`,
+# c2 and c3 follow cyclically if the handedness of the piece (taken from the solved cube) matches the handedness of the position.
+_corner_colors = np.zeros((8, 24, 3), dtype='uint8')
+for _n, (_i, _j, _k) in enumerate(pos_corners):
+    for _m, (_c1, _c2, _c3) in enumerate(colors_corners):
+        _piecesign = (2*(_c1%2)-1) * (2*(_c2%2)-1) * (2*(_c3%2)-1)
+        _cs = [_c1, _c2, _c3] if _piecesign == _i*_j*_k else [_c1, _c3, _c2]
+        for _o in range(3):
+            for _f in range(3):
+                _corner_colors[_n, 8*_o + _m, (_f+_o)%3] = _cs[_f]
+# Colors of the stickers of an edge with value 12*orientation + colors
+_edge_colors = np.array([ colors_edges[v%12][::(1 if v < 12 else -1)] for v in range(24) ], dtype='uint8')
+
+
+def faces2pieces(faces):
+    '''Converts from faces format to pieces format, i. e. 6x3x3 --> 20 or Bx6x3x3 --> Bx20'''
+    faces = np.asarray(faces)
+    single = faces.ndim == 3
+    faces = faces.reshape(-1, 6*3*3)
+    
+    # Corners: the colors encode the piece, the dimension of the lowest color is the orientation
+    cc = faces[:, _corner_stickers]
+    colors = np.sum((cc % 2) * (4 >> (cc // 2)), axis=2) # colors (c1, c2, c3) --> 4*(c1%2) + 2*(c2%2) + c3%2
+    corners = 8*np.argmin(cc, axis=2) + colors
+    
+    # Edges: the orientation is the sticker with the lower color
+    ec = faces[:, _edge_stickers]
+    ori = ec[:, :, 1] < ec[:, :, 0]
+    edges = 12*ori + _edge_ids[np.min(ec, axis=2), np.max(ec, axis=2)]
+    
+    pieces = np.concatenate([corners, edges], axis=1).astype('uint8')
+    return pieces[0] if single else pieces
+
+
+def pieces2faces(pieces):
+    '''Converts from pieces format to faces format, i. e. 20 --> 6x3x3 or Bx20 --> Bx6x3x3'''
+    pieces = np.asarray(pieces)
+    single = pieces.ndim == 1
+    pieces = pieces.reshape(-1, 20)
+    faces = np.zeros((len(pieces), 6*3*3), dtype='uint8')
+    faces[:, _center_stickers] = _center_colors
+    faces[:, _corner_stickers] = _corner_colors[np.arange(8), pieces[:, :8]]
+    faces[:, _edge_stickers] = _edge_colors[pieces[:, 8:]]
+    faces = faces.reshape(-1, 6, 3, 3)
+    return faces[0] if single else faces
+
+
+
+class BatchedRubiksCube():
+    '''B cubes in one (B,N,N,N,3) array. All operations act on the whole batch at once.'''
+    def __init__(self, B, N=3):
+        self.B = B
+        self.N = N
+        cube = RubiksCube(N)
+        self._cube0 = cube.cube
         
-        colors_corners = [ (c1, c2, c3) for c1 in [0,1] for c2 in [2,3] for c3 in [4,5] ]
-        pos_corners = [ (i, j, k) for i in [-1, 1] for j in [-1, 1] for k in [-1, 1] ]
+        # Moves are rows of a permutation table, row 0 is the identity (i. e. no move)
+        self._moves = [''] + list(_transforms.keys())
+        self._moves_rev = { m: k for k, m in enumerate(self._moves) }
+        self._permtable = np.stack([np.arange(N*N*N*3)] + [ cube._perms[m] for m in self._moves[1:] ])
+        self.reset()
         
-        # Corner pieces
-        for n in range(8):
-            colors = pieces[n] % 8
-            orientation = pieces[n] // 8
-            i, j, k = pos_corners[n]
-            c1, c2, c3 = colors_corners[colors]
-            
-            M = np.zeros((3,3))
-            ax0 = orientation
-            ax1 = (orientation+1)%3
-            ax2 = (orientation+2)%3
-            M[0, ax0] = [i,j,k][ax0]
-            M[1, ax1] = [i,j,k][ax1]
-            M[2, ax2] = [i,j,k][ax2]
-            sign = np.linalg.det(M)
-            
-            if _dict_piecesorientation[c1,c2,c3] != sign:
-                c1, c2, c3 = c1, c3, c2
-            for f in range(3):
-                self.cube[i+1,j+1,k+1,(f+orientation)%3] = [c1,c2,c3][f]
-            
-                
-                
-        colors_edges = [ (c1, c2) for c1 in range(6) for c2 in range(6) if c1 < c2 and c1//2 != c2//2 ]
-        pos_edges = [ (i, j, k) for i in range(3) for j in range(3) for k in range(3) if abs(i-1)+abs(j-1)+abs(k-1)==2 ]
-        
-        # Edge pieces
-        for n in range(12):
-            colors = pieces[n+8] % 12
-            orientation = pieces[n+8] // 12
-            i, j, k = pos_edges[n]
-            c1, c2 = colors_edges[colors]
-            if orientation==1:
-                c1, c2 = c2, c1
-            left_dim = np.argmin([abs(i-1), abs(j-1), abs(k-1)])
-            for f in range(3):
-                if [i,j,k][f] == 1: # edge has no face looking in dimension f
-                    continue
-                l = f - (f>left_dim)
-                self.cube[i,j,k,f] = [c1,c2][l]
-                          
\ No newline at end of file
+    def reset(self):
+        '''Resets all cubes to the solved state'''
+        self.cube = np.repeat(self._cube0[None], self.B, axis=0)
+        
+    def __len__(self):
+        return self.B
+        
+    def copy(self):
+        '''Creates a copy of these cubes'''
+        cpy = self.__class__(self.B, self.N)
+        cpy.cube = self.cube.copy()
+        return cpy
+    
+    def tocube(self, b):
+        '''Returns cube number b as a RubiksCube'''
+        cube = RubiksCube(self.N)
+        cube.cube = self.cube[b].copy()
+        return cube
+        
+    def rotate(self, moves):
+        '''Applies a move vector, i. e. one move per cube. `moves` is a sequence of length B of move chars or of
+        indices into `self._moves` (0 for no move). A BxT array applies T moves per cube, a string applies its moves to all cubes.'''
+        if isinstance(moves, str):
+            for m in moves:
+                self.rotate(np.full(self.B, self._moves_rev.get(m, 0)))
+            return
+        
+        moves = np.asarray(moves)
+        if moves.ndim == 2:
+            for t in range(moves.shape[1]):
+                self.rotate(moves[:, t])
+            return
+        
+        assert len(moves) == self.B, f'Need one move per cube, got {len(moves)} moves for {self.B} cubes!'
+        if moves.dtype.kind in 'US': # move chars, unknown moves are ignored
+            ms, inv = np.unique(moves, return_inverse=True)
+            moves = np.array([ self._moves_rev.get(m, 0) for m in ms ])[inv]
+        perms = self._permtable[moves]
+        self.cube = np.take_along_axis(self.cube.reshape(self.B, -1), perms, axis=1).reshape(self.cube.shape)
+        
+    def shuffle(self, n=15):
+        '''Performs n random face moves on every cube'''
+        self.rotate(np.random.randint(1, 13, size=(self.B, n))) # rows 1..12 are the face moves
+        
+    def getfaces(self):
+        '''Returns the faces of all cubes, i. e. a Bx6x3x3 array with numbers in 0..5'''
+        assert self.N == 3
+        return self.cube.reshape(self.B, -1)[:, _faces_inds].reshape(self.B, 6, 3, 3)
+    
+    def issolved(self):
+        '''Checks for every cube if it is solved and rotated in the right way(!)'''
+        faces = self.getfaces().reshape(self.B, 6, -1)
+        return np.all(faces == faces[:, :, :1], axis=(1, 2))
+    
+    def getpieces(self):
+        '''Returns the pieces of all cubes, i. e. a Bx20 array'''
+        return faces2pieces(self.getfaces())
+    
+    def frompieces(self, pieces):
+        '''Get the cubes from a Bx20 array of pieces'''
+        self.fromfaces(pieces2faces(pieces))
+        
+    def fromfaces(self, faces):
+        '''Get the cubes from a Bx6x3x3 array of faces'''
+        assert self.N == 3
+        assert len(faces) == self.B
+        cube = self.cube.reshape(self.B, -1).copy()
+        cube[:, _faces_inds] = faces.reshape(self.B, -1)
+        self.cube = cube.reshape(self.cube.shape)
+
+
+def cube_rotations():
+    '''Returns the 24 rotations of the cube as strings of the moves X, Y, Z, found by a breadth first search (the first one is the identity)'''
+    c = RubiksCube(3)
+    rotations, keys = [], set()
+    queue = ['']
+    while queue:
+        ms = queue.pop(0)
+        c.fromfaces(np.arange(6*3*3).reshape((6,3,3)))
+        c.rotate(ms)
+        key = c.getfaces().tobytes()
+        if key in keys:
+            continue
+        keys.add(key)
+        rotations.append(ms)
+        queue += [ ms + m for m in ['X', 'Y', 'Z'] ]
+    return rotations
+
+
+def rotation_speed(N=3, n=2000):
+    'Speed of `rotate_slow` and `rotate` in moves/s'
+    from time import time
+    cube = RubiksCube(N)
+    ms = np.random.choice(list(_transforms.keys()), n)
+    t0 = time()
+    for m in ms:
+        cube.rotate_slow(m)
+    t1 = time()
+    for m in ms:
+        cube.rotate(m)
+    t2 = time()
+    return n/(t1-t0), n/(t2-t1)
@@ -3,10 +3,11 @@ Accelerated version of the rubiks cube. Implemented by functions rather than per
 (c) 20.9.2020 mha
 '''
 from rubiks_cube import *
-import pickle
 from numba import jit, njit, prange
 from numba.types import byte
 
+from rubiks_tables import load_tables
+
 moves = ['F', 'B', 'R', 'L', 'U', 'D'] + ['f', 'b', 'r', 'l', 'u', 'd']
 moves_big = ['F', 'B', 'R', 'L', 'U', 'D'] + ['f', 'b', 'r', 'l', 'u', 'd'] + ['X', 'Y', 'Z'] + ['i', 'j', 'k']
 moves_big_rev = { m: k for k, m in enumerate(moves_big) }
@@ -58,43 +59,41 @@ with open('moves_faces.pkl', 'rb') as f:
 '''
 
 
-# Generate dictionary for applying the moves in faces format
-def _generate_dict():
+# Permutations for applying the moves in faces format: after move m, the sticker k is faces.flatten()[perm[m, k]]
+def _generate_tables():
+    '''Generates the move permutations by following labelled stickers through each move'''
     c = RubiksCube()
-    _d = dict()
-    _k = set()
-    for m in moves_big:
-        _k.add(m)
-        for k in range(6*3*3):
-            faces = np.zeros(6*3*3, dtype='uint8')
-            faces[k] = 1
-            faces = faces.reshape((6,3,3))
-            c.fromfaces(faces)
-            c.rotate(m)
-            targetfaces = c.getfaces()
-            l = np.argmax(targetfaces.flatten())
-            if k != l:
-                _d[m, k] = l
-    return _d, _k
+    perm = np.zeros((len(moves_big), 6*3*3), dtype='int64')
+    for i, m in enumerate(moves_big):
+        c.fromfaces(np.arange(6*3*3).reshape((6,3,3)))
+        c.rotate(m)
+        perm[i] = c.getfaces().flatten()
+    return dict(perm=perm)
+
 
-_d, _k = _generate_dict()
+def _tables():
+    '''Move permutations, loaded on first use'''
+    return load_tables('faces_moves', _generate_tables)['perm']
 
 
 def apply(faces, m):
     '''Applies the move m (string or int) to the cube in faces format'''
-    faces = faces.flatten()
-    resfaces = np.zeros_like(faces)
-    #if type(m) is not str:
-    if not isinstance(m, str):
-        m = moves_big[m]
-    assert m in _k, f'Unknown move {m}!' 
-    for k in range(6*3*3):
-        if (m, k) in _d.keys():
-            l = _d[m,k]
-            resfaces[l] = faces[k]
-        else:
-            resfaces[k] = faces[k]
-    return resfaces.reshape((6,3,3))
+    if isinstance(m, str):
+        assert m in moves_big_rev, f'Unknown move {m}!'
+        m = moves_big_rev[m]
+    return faces.reshape(6*3*3)[_tables()[m]].reshape((6,3,3))
+
+
+def apply_batch(faces, ms):
+    '''Applies one move per cube, i. e. faces is a Bx6x3x3 array and ms is a vector of B move indices'''
+    faces = faces.reshape(len(faces), 6*3*3)
+    return np.take_along_axis(faces, _tables()[ms], axis=1).reshape((-1,6,3,3))
+
+
+def apply_all_moves(faces):
+    '''Applies all 12 moves to every cube, i. e. Bx6x3x3 --> Bx12x6x3x3'''
+    faces = faces.reshape(len(faces), 6*3*3)
+    return faces[:, _tables()[:12]].reshape((-1,12,6,3,3))
 
 
 
@@ -161,6 +160,22 @@ def shuffle(faces=None, n=15):
     return faces
 
 
+def shuffle_batch(B, n=15):
+    '''Returns B cubes in faces format on which n random moves were performed'''
+    faces = np.repeat(_faces0[None], B, axis=0)
+    for _ in range(n):
+        faces = apply_batch(faces, np.random.randint(12, size=B))
+    return faces
+
+
+def scramble(n, depth=30, seed=None, no_inverse=False, no_repeat=False):
+    '''Scrambles n cubes in parallel and returns them in faces format, see rubiks_cube_pieces.scramble.
+    Returns the nx6x3x3 faces and the nxmax(depth) move indices (-1 after the end of a scramble).'''
+    from rubiks_cube_pieces import scramble as scramble_pieces
+    states, ms = scramble_pieces(n, depth, seed=seed, no_inverse=no_inverse, no_repeat=no_repeat)
+    return pieces2faces(states), ms
+
+
 def issolved(faces):
     '''Checks if the cube is solved'''
     for k in range(6): 
@@ -193,58 +208,40 @@ def colornormalization(faces):
 
 
 
-# Generate random augmentations
-def _generate_augmentations(n):
+# Augmentations are the 24 rotations of the cube. The sticker k is moved to aug_dest[i, k] and the color c becomes aug_colors[i, c]
+def _generate_augmentations():
+    '''Generates the tables of the 24 rotations'''
     c = RubiksCube()
-    _d_p = dict() # moves
-    _d_c = dict() # colors
+    rotations = cube_rotations()
     
-    for i in range(n):
-        moves = np.random.choice(['x', 'y', 'z', 'mx', 'my', 'mz'], 20)
-        for k in range(6*3*3):
-            
-            # position permutation
-            faces = np.zeros(6*3*3, dtype='uint8')
-            faces[k] = 1
-            faces = faces.reshape((6,3,3))
-            c.fromfaces(faces)
-            for m in moves:
-                c.rotate(m)
-            targetfaces = c.getfaces()
-            l = np.argmax(targetfaces.flatten())
-            if k != l:
-                _d_p[i, k] = l
-                
-            # color permutation
-            c.reset()
-            for m in moves:
-                c.rotate(m)
-            faces = c.getfaces()
-            for k in range(6):
-                _d_c[i, faces[k, 1, 1]] = _faces0[k, 1, 1]
-    return _d_p, _d_c
+    aug_dest = np.zeros((len(rotations), 6*3*3), dtype='int64')
+    aug_colors = np.zeros((len(rotations), 6), dtype='uint8')
+    for i, ms in enumerate(rotations):
+        # position permutation
+        c.fromfaces(np.arange(6*3*3).reshape((6,3,3)))
+        c.rotate(ms)
+        aug_dest[i, c.getfaces().flatten()] = np.arange(6*3*3)
+        
+        # color permutation
+        c.reset()
+        c.rotate(ms)
+        faces = c.getfaces()
+        for k in range(6):
+            aug_colors[i, faces[k, 1, 1]] = _faces0[k, 1, 1]
+    return dict(aug_dest=aug_dest, aug_colors=aug_colors)
             
             
-_num_augment = 200
-#_d_aug_p, _d_aug_c = _generate_augmentations(_num_augment)
-#with open('augmentations.pkl', 'wb') as f:
-#    pickle.dump((_d_aug_p, _d_aug_c), f)
-with open('augmentations.pkl', 'rb') as f:
-    _d_aug_p, _d_aug_c = pickle.load(f)
+_num_augment = 24
 
     
 def augment(faces, i=None):
+    '''Rotates the cube by the rotation i (random if None) and normalizes the colors'''
     if i is None:
         i = np.random.randint(_num_augment)
-        
+    tables = load_tables('faces_augmentations', _generate_augmentations)
     faces = faces.flatten()
     resfaces = np.zeros_like(faces)
-    for k in range(6*3*3):
-        if (i,k) in _d_aug_p.keys():
-            l = _d_aug_p[i,k]
-            resfaces[l] = _d_aug_c[i,faces[k]]
-        else:
-            resfaces[k] = _d_aug_c[i,faces[k]]
+    resfaces[tables['aug_dest'][i]] = tables['aug_colors'][i][faces]
     return resfaces.reshape((6,3,3))
 
     
@@ -5,10 +5,13 @@ Instead of using the faces format (6x9 faces of the 26 pieces), here we use a re
 '''
 
 from rubiks_cube import *
+from rubiks_cube import _corner_stickers, _edge_stickers
 
-from numba import jit, njit
+from numba import jit, njit, prange
 from numba.types import byte
 
+from rubiks_tables import load_tables
+
 
 moves = ['F', 'B', 'R', 'L', 'U', 'D'] + ['f', 'b', 'r', 'l', 'u', 'd']
 moves_big = ['F', 'B', 'R', 'L', 'U', 'D'] + ['f', 'b', 'r', 'l', 'u', 'd'] + ['X', 'Y', 'Z']
@@ -48,16 +51,11 @@ def shuffle(state=None, n=30):
     return state
 
 
-def augment(state):
-    _cube.frompieces(state)
-    _cube.rotate(np.random.choice(['', 'x', 'xx', 'X']))
-    if np.random.rand() < 2/6:
-        _cube.rotate(np.random.choice(['', 'yy']))
-    else:
-        _cube.rotate('y')
-        _cube.rotate(np.random.choice(['', 'x', 'xx', 'X']))
-    _cube.colornormalization()
-    return _cube.getpieces()
+def augment(state, i=None):
+    '''Rotates the cube by the symmetry i (a random one of the 24 rotations if None) and normalizes the colors'''
+    if i is None:
+        i = np.random.randint(_num_augment)
+    return apply_symmetry(state[None], i)[0]
 
 
 @jit(cache=True)
@@ -104,7 +102,7 @@ def oh2pieces_fast(oh):
 
 
 oh2pieces = oh2pieces_fast
-_oh0 = pieces2oh(_state0)
+_oh0 = np.eye(24, dtype='uint8')[_state0] # = pieces2oh(_state0)
 
 
 # Generic function terminology
@@ -113,872 +111,379 @@ state2oh = pieces2oh
 shape_state = (20, 24)
 
 
-# Generate dictionary for applying the moves in faces format
-def _generate_dict():
-    colors_corners = [ (c1, c2, c3) for c1 in [0,1] for c2 in [2,3] for c3 in [4,5] ]
-    pos_corners = [ (i, j, k) for i in [-1, 1] for j in [-1, 1] for k in [-1, 1] ]
-    colors_edges = [ (c1, c2) for c1 in range(6) for c2 in range(6) if c1 < c2 and c1//2 != c2//2 ]
-    pos_edges = [ (i, j, k) for i in range(3) for j in range(3) for k in range(3) if abs(i-1)+abs(j-1)+abs(k-1)==2 ]
-    
-    state0 = _state0
+# Tables for applying the moves: the piece at position n is moved to position pos[m, n] and its orientation o becomes ori[m, n, o]
+def _generate_tables():
+    '''Generates the move tables by following the pieces of a cube (all in orientation o) through each move'''
     cube = RubiksCube()
-    _d_pos = dict()
-    _d_ori = dict()
-    _k = set()
-    
-    ready = False
-    while not ready:
-        cube.shuffle()
-        state0 = cube.getpieces()
-    
-        for m in moves_big:
-            _k.add(m)
+    pos = np.zeros((len(moves_big), 20), dtype='int64')
+    ori = np.tile(np.arange(3, dtype='uint8'), (len(moves_big), 20, 1)) # orientation 2 of the edges does not exist
+    for o in range(3):
+        state0 = np.array([ 8*o + n for n in range(8) ] + [ 12*min(o, 1) + n for n in range(12) ], dtype='uint8')
+        for k, m in enumerate(moves_big):
             cube.frompieces(state0)
             cube.rotate(m)
             state = cube.getpieces()
-            
- 
-            # Corners and edges in the same loop, see that N is either 8 (for corners) or 12 (for edges)
-            for n in range(20):
-                N = 8 if n<8 else 12
-                colors0 = state0[n] % N
-                ori0 = state0[n] // N
-                for l in range(20): 
-                    if (l<8)!=(n<8): continue # only compare corners with corners and edges with edges
-                    colors = state[l] % N
-                    ori = state[l] // N
-                    if colors == colors0:
-                        if n!=l: # only keep track about pieces which are moved
-                            _d_pos[m, n] = l
-                            _d_ori[m, n, ori0] = ori
-             
-
-        # Check if orientation dict for edges is ready
-        ready = True
-        for m in moves_big:
-            for n in range(8):
-                if not (m, n) in _d_pos.keys():
-                    continue
-                for o in range(3):
-                    if not (m, n, o) in _d_ori.keys():
-                        ready = False
-                        
-                        
-    return _d_pos, _d_ori, _k
-
-
-
-_d_pos, _d_ori, _k = _generate_dict()
-
-def apply_slow(state0, m):
-    state = np.zeros(20, dtype='uint8')
-    
+            for l in range(20):
+                N = 8 if l<8 else 12
+                n = state[l] % N + (0 if l<8 else 8) # the piece at position l came from position n
+                pos[k, n] = l
+                if l<8 or o<2:
+                    ori[k, n, o] = state[l] // N
+    return dict(pos=pos, ori=ori)
+
+
+def _tables():
+    '''Move tables (pos, ori), loaded on first use'''
+    tables = load_tables('pieces_moves', _generate_tables)
+    return tables['pos'], tables['ori']
+
+
+@njit(cache=True)
+def _apply(state0, m, pos, ori):
+    '''Applies the move with index m'''
+    state = np.empty(20, dtype=byte)
     for n in range(20):
         N = 8 if n<8 else 12
-        if (m, n) in _d_pos.keys(): # check if piece is moved or standing still
-            l = _d_pos[m, n]
-            ori0 = state0[n] // N
-            ori = _d_ori[m, n, ori0]
-            state[l] = state0[n]%N + N*ori
-        else:
-            state[n] = state0[n]
-    
+        state[pos[m,n]] = state0[n]%N + N*ori[m,n,state0[n]//N]
     return state
+
+
+@njit(cache=True)
+def _apply_moves(state, ms, pos, ori):
+    '''Applies the moves with indices ms one after another'''
+    for m in ms:
+        state = _apply(state, m, pos, ori)
+    return state
+
+
+@njit(cache=True, parallel=True)
+def _apply_batch(states, ms, pos, ori):
+    res = np.empty_like(states)
+    for b in prange(len(states)):
+        res[b] = _apply(states[b], ms[b], pos, ori)
+    return res
+
+
+@njit(cache=True, parallel=True)
+def _apply_all_moves(states, pos, ori):
+    res = np.empty((len(states), 12, 20), dtype=states.dtype)
+    for b in prange(len(states)):
+        for m in range(12):
+            res[b, m] = _apply(states[b], m, pos, ori)
+    return res
+
+
+def apply(state, m):
+    '''Applies the move(s) m (string or int) to the cube in pieces format'''
+    if isinstance(m, str):
+        ms = np.array([ moves_big_rev[mm] for mm in m ], dtype='int64')
+    else:
+        ms = np.array([m], dtype='int64')
+    return _apply_moves(np.asarray(state, dtype='uint8'), ms, *_tables())
+
+
+def apply_batch(states, ms):
+    '''Applies one move per state, i. e. states is a Bx20 array and ms is a vector of B move indices'''
+    return _apply_batch(np.asarray(states, dtype='uint8'), np.asarray(ms, dtype='int64'), *_tables())
+
+
+def apply_all_moves(states):
+    '''Applies all 12 moves to every state, i. e. Bx20 --> Bx12x20'''
+    return _apply_all_moves(np.asarray(states, dtype='uint8'), *_tables())
+
+
+
+# Scrambles. The random numbers are drawn in chunks of fixed size, each chunk by its own np.random.Generator spawned from
+# one SeedSequence, so the result only depends on the seed and not on the number of threads. A random number r in 0..659
+# selects the (r % count)-th allowed move, which is unbiased since 660 is divisible by 12, 11 and 10.
+_scramble_chunk = 4096
+_scramble_lcm = 660
+
+
+@njit(cache=True)
+def _allowed(m, last, mode):
+    '''Is move m allowed after the move last? mode 0: all moves, 1: no inverse moves, 2: no moves of the same face'''
+    if last < 0 or mode == 0:
+        return True
+    if mode == 1:
+        return m != (last+6) % 12
+    return m % 6 != last % 6
+
+
+@njit(cache=True, parallel=True)
+def _scramble(states, rand, depths, mode, pos, ori):
+    ms = np.full(rand.shape, -1, dtype=np.int8)
+    for b in prange(len(states)):
+        state = states[b]
+        last = -1
+        for t in range(depths[b]):
+            count = 12 if last < 0 else 12 - mode
+            k = rand[b, t] % count
+            for m in range(12):
+                if _allowed(m, last, mode):
+                    if k == 0:
+                        break
+                    k -= 1
+            state = _apply(state, m, pos, ori)
+            ms[b, t] = m
+            last = m
+        states[b] = state
+    return ms
+
+
+def scramble(n, depth=30, seed=None, no_inverse=False, no_repeat=False, states=None):
+    '''Scrambles n cubes in parallel, e. g. scramble(640, 1000) for an evaluation set.
+    depth: number of moves, one for all cubes or a vector of n depths
+    seed: seed of the SeedSequence the generators of the chunks are spawned from
+    no_inverse: do not undo the last move
+    no_repeat: do not move the same face twice in a row (implies no_inverse)
+    states: start states (default is the solved cube)
+    Returns the nx20 states and the nxmax(depth) move indices (-1 after the end of a scramble).'''
+    depths = np.broadcast_to(np.asarray(depth, dtype='int64'), (n,))
+    maxdepth = int(np.max(depths)) if n > 0 else 0
+    states = np.repeat(_state0[None], n, axis=0) if states is None else np.array(states, dtype='uint8')
+    mode = 2 if no_repeat else (1 if no_inverse else 0)
     
-    
-    
-# die schnelle Variante von ´apply´ wird mit jit dekoriert. Da jit sich nicht mit dictionarys verträgt, erstellt folgende
-# Funktion den Quellcode für die Funktion ´apply´ weiter unten. Dort ist der Inhalt der dictionary Objekte explizite enthalten.
-    
-def makesnippet():
-    tab = '    '
-    lines = []
-    lines.append('@njit(cache=True)')
-    lines.append('def apply3(state0, m):')
-    lines.append(tab + 'state = np.zeros(20, dtype=byte)')
-    lines.append('\n')
-    lines.append(tab + 'for n in range(20):')
-    lines.append(tab + tab + 'N = 8 if n<8 else 12')
-    
-    lines.append(tab + tab + '#### Beginning part of _d_pos ####')
-    lines.append(tab + tab + 'foundinkeys = True')
-    lines.append(tab + tab + 'if False: pass')
-    for m in moves_big:
-        #if m != 'F': break
-        lines.append(tab + tab + f'elif m==\'{m}\':')
-        lines.append(tab + tab + tab + 'if False: pass')
-        for (m2, n), l in _d_pos.items():
-            if m!=m2: continue
-            l = _d_pos[m, n]
-            lines.append(tab + tab + tab + f'elif n=={n}: l={l}')
-        lines.append(tab + tab + tab + 'else: foundinkeys = False')
-        
-    lines.append(tab + tab + '#### Beginning part of _d_ori ####')
-    lines.append(tab + tab + 'if foundinkeys:')
-    lines.append(tab + tab + tab + 'ori0 = state0[n] // N')
-    lines.append(tab + tab + tab + 'if False: pass')
-    for m in moves_big:
-        lines.append(tab + tab + tab + f'elif m==\'{m}\':')
-        lines.append(tab + tab + tab + tab + 'if False: pass')
-        for ori0 in range(3):
-            lines.append(tab + tab + tab + tab + f'elif ori0=={ori0}:')
-            lines.append(tab + tab + tab + tab + tab + 'if False: pass')
-            for (m2, n, ori2) in _d_ori.keys():
-                if m2!=m or ori2!=ori0: continue
-                ori = _d_ori[m, n, ori0]
-                lines.append(tab + tab + tab + tab + tab + f'elif n=={n}: ori={ori}')
-                
-            
-    s =  ''.join([l + '\n' for l in lines])
-    
-    s += '''
-            state[l] = state0[n]%N + N*ori
-        else:
-            state[n] = state0[n]
-            
-    return state'''
+    nchunks = (n + _scramble_chunk - 1) // _scramble_chunk
+    rngs = [ np.random.default_rng(s) for s in np.random.SeedSequence(seed).spawn(nchunks) ]
+    rand = np.concatenate([ rng.integers(0, _scramble_lcm, size=(min(_scramble_chunk, n - c*_scramble_chunk), maxdepth), dtype='uint16')
+                            for c, rng in enumerate(rngs) ] + [ np.zeros((0, maxdepth), dtype='uint16') ])
+    ms = _scramble(states, rand, depths, mode, *_tables())
+    return states, ms
 
-    return s
 
 
+# Perfect ranking of the states. A state is given by corner permutation x corner orientation x edge permutation x edge orientation.
+# The orientation of the last corner and edge and the parity of the edge permutation (equals the corner one) are determined by the rest,
+# which leaves 8! * 3^7 * 12!/2 * 2^11 = 4.3e19 states. Since this is more than 2^64, the batched functions use pairs of keys
+# (corner key < 8! * 3^7, edge key < 12!/2 * 2^11), while `rank` returns the combined python int corner key * n_edgekeys + edge key.
+n_cornerkeys = 40320 * 3**7
+n_edgekeys = 479001600//2 * 2**11
+n_states = n_cornerkeys * n_edgekeys
+
+_chirality = np.array([ i*j*k for i, j, k in pos_corners ], dtype='int64') # +-1, twist of the corners is sum(orientation*chirality) = 0 mod 3
+
 
 @njit(cache=True)
-def _apply(state0, m):
-    state = np.zeros(20, dtype=byte)
+def _rank_perm(p):
+    'Lehmer rank and parity of the permutation p'
+    n = len(p)
+    r, parity = 0, 0
+    for i in range(n):
+        d = 0
+        for j in range(i+1, n):
+            if p[j] < p[i]:
+                d += 1
+        r = r*(n-i) + d
+        parity += d
+    return r, parity % 2
 
 
-    for n in range(20):
-        N = 8 if n<8 else 12
-        #### Beginning part of _d_pos ####
-        foundinkeys = True
-        if False: pass
-        elif m=='F':
-            if False: pass
-            elif n==4: l=5
-            elif n==5: l=7
-            elif n==6: l=4
-            elif n==7: l=6
-            elif n==16: l=18
-            elif n==17: l=16
-            elif n==18: l=19
-            elif n==19: l=17
-            else: foundinkeys = False
-        elif m=='B':
-            if False: pass
-            elif n==0: l=2
-            elif n==1: l=0
-            elif n==2: l=3
-            elif n==3: l=1
-            elif n==8: l=9
-            elif n==9: l=11
-            elif n==10: l=8
-            elif n==11: l=10
-            else: foundinkeys = False
-        elif m=='R':
-            if False: pass
-            elif n==2: l=6
-            elif n==3: l=2
-            elif n==6: l=7
-            elif n==7: l=3
-            elif n==11: l=14
-            elif n==14: l=19
-            elif n==15: l=11
-            elif n==19: l=15
-            else: foundinkeys = False
-        elif m=='L':
-            if False: pass
-            elif n==0: l=1
-            elif n==1: l=5
-            elif n==4: l=0
-            elif n==5: l=4
-            elif n==8: l=13
-            elif n==12: l=8
-            elif n==13: l=16
-            elif n==16: l=12
-            else: foundinkeys = False
-        elif m=='U':
-            if False: pass
-            elif n==1: l=3
-            elif n==3: l=7
-            elif n==5: l=1
-            elif n==7: l=5
-            elif n==10: l=15
-            elif n==13: l=10
-            elif n==15: l=18
-            elif n==18: l=13
-            else: foundinkeys = False
-        elif m=='D':
-            if False: pass
-            elif n==0: l=4
-            elif n==2: l=0
-            elif n==4: l=6
-            elif n==6: l=2
-            elif n==9: l=12
-            elif n==12: l=17
-            elif n==14: l=9
-            elif n==17: l=14
-            else: foundinkeys = False
-        elif m=='f':
-            if False: pass
-            elif n==4: l=6
-            elif n==5: l=4
-            elif n==6: l=7
-            elif n==7: l=5
-            elif n==16: l=17
-            elif n==17: l=19
-            elif n==18: l=16
-            elif n==19: l=18
-            else: foundinkeys = False
-        elif m=='b':
-            if False: pass
-            elif n==0: l=1
-            elif n==1: l=3
-            elif n==2: l=0
-            elif n==3: l=2
-            elif n==8: l=10
-            elif n==9: l=8
-            elif n==10: l=11
-            elif n==11: l=9
-            else: foundinkeys = False
-        elif m=='r':
-            if False: pass
-            elif n==2: l=3
-            elif n==3: l=7
-            elif n==6: l=2
-            elif n==7: l=6
-            elif n==11: l=15
-            elif n==14: l=11
-            elif n==15: l=19
-            elif n==19: l=14
-            else: foundinkeys = False
-        elif m=='l':
-            if False: pass
-            elif n==0: l=4
-            elif n==1: l=0
-            elif n==4: l=5
-            elif n==5: l=1
-            elif n==8: l=12
-            elif n==12: l=16
-            elif n==13: l=8
-            elif n==16: l=13
-            else: foundinkeys = False
-        elif m=='u':
-            if False: pass
-            elif n==1: l=5
-            elif n==3: l=1
-            elif n==5: l=7
-            elif n==7: l=3
-            elif n==10: l=13
-            elif n==13: l=18
-            elif n==15: l=10
-            elif n==18: l=15
-            else: foundinkeys = False
-        elif m=='d':
-            if False: pass
-            elif n==0: l=2
-            elif n==2: l=6
-            elif n==4: l=0
-            elif n==6: l=4
-            elif n==9: l=14
-            elif n==12: l=9
-            elif n==14: l=17
-            elif n==17: l=12
-            else: foundinkeys = False
-        elif m=='X':
-            if False: pass
-            elif n==0: l=1
-            elif n==1: l=3
-            elif n==2: l=0
-            elif n==3: l=2
-            elif n==4: l=5
-            elif n==5: l=7
-            elif n==6: l=4
-            elif n==7: l=6
-            elif n==8: l=10
-            elif n==9: l=8
-            elif n==10: l=11
-            elif n==11: l=9
-            elif n==12: l=13
-            elif n==13: l=15
-            elif n==14: l=12
-            elif n==15: l=14
-            elif n==16: l=18
-            elif n==17: l=16
-            elif n==18: l=19
-            elif n==19: l=17
-            else: foundinkeys = False
-        elif m=='Y':
-            if False: pass
-            elif n==0: l=4
-            elif n==1: l=0
-            elif n==2: l=6
-            elif n==3: l=2
-            elif n==4: l=5
-            elif n==5: l=1
-            elif n==6: l=7
-            elif n==7: l=3
-            elif n==8: l=12
-            elif n==9: l=17
-            elif n==10: l=9
-            elif n==11: l=14
-            elif n==12: l=16
-            elif n==13: l=8
-            elif n==14: l=19
-            elif n==15: l=11
-            elif n==16: l=13
-            elif n==17: l=18
-            elif n==18: l=10
-            elif n==19: l=15
-            else: foundinkeys = False
-        elif m=='Z':
-            if False: pass
-            elif n==0: l=2
-            elif n==1: l=3
-            elif n==2: l=6
-            elif n==3: l=7
-            elif n==4: l=0
-            elif n==5: l=1
-            elif n==6: l=4
-            elif n==7: l=5
-            elif n==8: l=11
-            elif n==9: l=14
-            elif n==10: l=15
-            elif n==11: l=19
-            elif n==12: l=9
-            elif n==13: l=10
-            elif n==14: l=17
-            elif n==15: l=18
-            elif n==16: l=8
-            elif n==17: l=12
-            elif n==18: l=13
-            elif n==19: l=16
-            else: foundinkeys = False
-        #### Beginning part of _d_ori ####
-        if foundinkeys:
-            ori0 = state0[n] // N
-            if False: pass
-            elif m=='F':
-                if False: pass
-                elif ori0==0:
-                    if False: pass
-                    elif n==4: ori=0
-                    elif n==6: ori=0
-                    elif n==17: ori=0
-                    elif n==18: ori=0
-                    elif n==19: ori=0
-                    elif n==7: ori=0
-                    elif n==16: ori=0
-                    elif n==5: ori=0
-                elif ori0==1:
-                    if False: pass
-                    elif n==5: ori=2
-                    elif n==16: ori=1
-                    elif n==6: ori=2
-                    elif n==7: ori=2
-                    elif n==17: ori=1
-                    elif n==18: ori=1
-                    elif n==4: ori=2
-                    elif n==19: ori=1
-                elif ori0==2:
-                    if False: pass
-                    elif n==7: ori=1
-                    elif n==5: ori=1
-                    elif n==4: ori=1
-                    elif n==6: ori=1
-            elif m=='B':
-                if False: pass
-                elif ori0==0:
-                    if False: pass
-                    elif n==1: ori=0
-                    elif n==10: ori=0
-                    elif n==11: ori=0
-                    elif n==2: ori=0
-                    elif n==9: ori=0
-                    elif n==0: ori=0
-                    elif n==3: ori=0
-                    elif n==8: ori=0
-                elif ori0==1:
-                    if False: pass
-                    elif n==0: ori=2
-                    elif n==8: ori=1
-                    elif n==9: ori=1
-                    elif n==11: ori=1
-                    elif n==10: ori=1
-                    elif n==1: ori=2
-                    elif n==2: ori=2
-                    elif n==3: ori=2
-                elif ori0==2:
-                    if False: pass
-                    elif n==2: ori=1
-                    elif n==3: ori=1
-                    elif n==0: ori=1
-                    elif n==1: ori=1
-            elif m=='R':
-                if False: pass
-                elif ori0==0:
-                    if False: pass
-                    elif n==6: ori=2
-                    elif n==11: ori=1
-                    elif n==14: ori=1
-                    elif n==15: ori=1
-                    elif n==19: ori=1
-                    elif n==2: ori=2
-                    elif n==7: ori=2
-                    elif n==3: ori=2
-                elif ori0==1:
-                    if False: pass
-                    elif n==6: ori=1
-                    elif n==11: ori=0
-                    elif n==14: ori=0
-                    elif n==7: ori=1
-                    elif n==2: ori=1
-                    elif n==3: ori=1
-                    elif n==19: ori=0
-                    elif n==15: ori=0
-                elif ori0==2:
-                    if False: pass
-                    elif n==2: ori=0
-                    elif n==3: ori=0
-                    elif n==7: ori=0
-                    elif n==6: ori=0
-            elif m=='L':
-                if False: pass
-                elif ori0==0:
-                    if False: pass
-                    elif n==1: ori=2
-                    elif n==4: ori=2
-                    elif n==13: ori=1
-                    elif n==16: ori=1
-                    elif n==0: ori=2
-                    elif n==5: ori=2
-                    elif n==12: ori=1
-                    elif n==8: ori=1
-                elif ori0==1:
-                    if False: pass
-                    elif n==0: ori=1
-                    elif n==5: ori=1
-                    elif n==8: ori=0
-                    elif n==12: ori=0
-                    elif n==16: ori=0
-                    elif n==13: ori=0
-                    elif n==1: ori=1
-                    elif n==4: ori=1
-                elif ori0==2:
-                    if False: pass
-                    elif n==5: ori=0
-                    elif n==4: ori=0
-                    elif n==0: ori=0
-                    elif n==1: ori=0
-            elif m=='U':
-                if False: pass
-                elif ori0==0:
-                    if False: pass
-                    elif n==1: ori=1
-                    elif n==10: ori=0
-                    elif n==13: ori=0
-                    elif n==15: ori=0
-                    elif n==18: ori=0
-                    elif n==7: ori=1
-                    elif n==3: ori=1
-                    elif n==5: ori=1
-                elif ori0==1:
-                    if False: pass
-                    elif n==5: ori=0
-                    elif n==13: ori=1
-                    elif n==7: ori=0
-                    elif n==10: ori=1
-                    elif n==1: ori=0
-                    elif n==18: ori=1
-                    elif n==3: ori=0
-                    elif n==15: ori=1
-                elif ori0==2:
-                    if False: pass
-                    elif n==3: ori=2
-                    elif n==7: ori=2
-                    elif n==5: ori=2
-                    elif n==1: ori=2
-            elif m=='D':
-                if False: pass
-                elif ori0==0:
-                    if False: pass
-                    elif n==4: ori=1
-                    elif n==6: ori=1
-                    elif n==14: ori=0
-                    elif n==17: ori=0
-                    elif n==2: ori=1
-                    elif n==9: ori=0
-                    elif n==0: ori=1
-                    elif n==12: ori=0
-                elif ori0==1:
-                    if False: pass
-                    elif n==0: ori=0
-                    elif n==9: ori=1
-                    elif n==12: ori=1
-                    elif n==6: ori=0
-                    elif n==14: ori=1
-                    elif n==17: ori=1
-                    elif n==2: ori=0
-                    elif n==4: ori=0
-                elif ori0==2:
-                    if False: pass
-                    elif n==2: ori=2
-                    elif n==4: ori=2
-                    elif n==0: ori=2
-                    elif n==6: ori=2
-            elif m=='f':
-                if False: pass
-                elif ori0==0:
-                    if False: pass
-                    elif n==4: ori=0
-                    elif n==6: ori=0
-                    elif n==17: ori=0
-                    elif n==18: ori=0
-                    elif n==19: ori=0
-                    elif n==7: ori=0
-                    elif n==16: ori=0
-                    elif n==5: ori=0
-                elif ori0==1:
-                    if False: pass
-                    elif n==5: ori=2
-                    elif n==16: ori=1
-                    elif n==6: ori=2
-                    elif n==7: ori=2
-                    elif n==17: ori=1
-                    elif n==18: ori=1
-                    elif n==4: ori=2
-                    elif n==19: ori=1
-                elif ori0==2:
-                    if False: pass
-                    elif n==7: ori=1
-                    elif n==5: ori=1
-                    elif n==4: ori=1
-                    elif n==6: ori=1
-            elif m=='b':
-                if False: pass
-                elif ori0==0:
-                    if False: pass
-                    elif n==1: ori=0
-                    elif n==10: ori=0
-                    elif n==11: ori=0
-                    elif n==2: ori=0
-                    elif n==9: ori=0
-                    elif n==0: ori=0
-                    elif n==3: ori=0
-                    elif n==8: ori=0
-                elif ori0==1:
-                    if False: pass
-                    elif n==0: ori=2
-                    elif n==8: ori=1
-                    elif n==9: ori=1
-                    elif n==11: ori=1
-                    elif n==10: ori=1
-                    elif n==1: ori=2
-                    elif n==2: ori=2
-                    elif n==3: ori=2
-                elif ori0==2:
-                    if False: pass
-                    elif n==2: ori=1
-                    elif n==3: ori=1
-                    elif n==0: ori=1
-                    elif n==1: ori=1
-            elif m=='r':
-                if False: pass
-                elif ori0==0:
-                    if False: pass
-                    elif n==6: ori=2
-                    elif n==11: ori=1
-                    elif n==14: ori=1
-                    elif n==15: ori=1
-                    elif n==19: ori=1
-                    elif n==2: ori=2
-                    elif n==7: ori=2
-                    elif n==3: ori=2
-                elif ori0==1:
-                    if False: pass
-                    elif n==6: ori=1
-                    elif n==11: ori=0
-                    elif n==14: ori=0
-                    elif n==7: ori=1
-                    elif n==2: ori=1
-                    elif n==3: ori=1
-                    elif n==19: ori=0
-                    elif n==15: ori=0
-                elif ori0==2:
-                    if False: pass
-                    elif n==2: ori=0
-                    elif n==3: ori=0
-                    elif n==7: ori=0
-                    elif n==6: ori=0
-            elif m=='l':
-                if False: pass
-                elif ori0==0:
-                    if False: pass
-                    elif n==1: ori=2
-                    elif n==4: ori=2
-                    elif n==13: ori=1
-                    elif n==16: ori=1
-                    elif n==0: ori=2
-                    elif n==5: ori=2
-                    elif n==12: ori=1
-                    elif n==8: ori=1
-                elif ori0==1:
-                    if False: pass
-                    elif n==0: ori=1
-                    elif n==5: ori=1
-                    elif n==8: ori=0
-                    elif n==12: ori=0
-                    elif n==16: ori=0
-                    elif n==13: ori=0
-                    elif n==1: ori=1
-                    elif n==4: ori=1
-                elif ori0==2:
-                    if False: pass
-                    elif n==5: ori=0
-                    elif n==4: ori=0
-                    elif n==0: ori=0
-                    elif n==1: ori=0
-            elif m=='u':
-                if False: pass
-                elif ori0==0:
-                    if False: pass
-                    elif n==1: ori=1
-                    elif n==10: ori=0
-                    elif n==13: ori=0
-                    elif n==15: ori=0
-                    elif n==18: ori=0
-                    elif n==7: ori=1
-                    elif n==3: ori=1
-                    elif n==5: ori=1
-                elif ori0==1:
-                    if False: pass
-                    elif n==5: ori=0
-                    elif n==13: ori=1
-                    elif n==7: ori=0
-                    elif n==10: ori=1
-                    elif n==1: ori=0
-                    elif n==18: ori=1
-                    elif n==3: ori=0
-                    elif n==15: ori=1
-                elif ori0==2:
-                    if False: pass
-                    elif n==3: ori=2
-                    elif n==7: ori=2
-                    elif n==5: ori=2
-                    elif n==1: ori=2
-            elif m=='d':
-                if False: pass
-                elif ori0==0:
-                    if False: pass
-                    elif n==4: ori=1
-                    elif n==6: ori=1
-                    elif n==14: ori=0
-                    elif n==17: ori=0
-                    elif n==2: ori=1
-                    elif n==9: ori=0
-                    elif n==0: ori=1
-                    elif n==12: ori=0
-                elif ori0==1:
-                    if False: pass
-                    elif n==0: ori=0
-                    elif n==9: ori=1
-                    elif n==12: ori=1
-                    elif n==6: ori=0
-                    elif n==14: ori=1
-                    elif n==17: ori=1
-                    elif n==2: ori=0
-                    elif n==4: ori=0
-                elif ori0==2:
-                    if False: pass
-                    elif n==2: ori=2
-                    elif n==4: ori=2
-                    elif n==0: ori=2
-                    elif n==6: ori=2
-            elif m=='X':
-                if False: pass
-                elif ori0==0:
-                    if False: pass
-                    elif n==1: ori=0
-                    elif n==4: ori=0
-                    elif n==6: ori=0
-                    elif n==10: ori=0
-                    elif n==11: ori=0
-                    elif n==13: ori=1
-                    elif n==14: ori=1
-                    elif n==15: ori=1
-                    elif n==17: ori=0
-                    elif n==18: ori=0
-                    elif n==19: ori=0
-                    elif n==2: ori=0
-                    elif n==7: ori=0
-                    elif n==9: ori=0
-                    elif n==16: ori=0
-                    elif n==0: ori=0
-                    elif n==3: ori=0
-                    elif n==5: ori=0
-                    elif n==12: ori=1
-                    elif n==8: ori=0
-                elif ori0==1:
-                    if False: pass
-                    elif n==0: ori=2
-                    elif n==5: ori=2
-                    elif n==8: ori=1
-                    elif n==9: ori=1
-                    elif n==12: ori=0
-                    elif n==16: ori=1
-                    elif n==6: ori=2
-                    elif n==11: ori=1
-                    elif n==13: ori=0
-                    elif n==14: ori=0
-                    elif n==7: ori=2
-                    elif n==10: ori=1
-                    elif n==17: ori=1
-                    elif n==1: ori=2
-                    elif n==2: ori=2
-                    elif n==18: ori=1
-                    elif n==4: ori=2
-                    elif n==3: ori=2
-                    elif n==19: ori=1
-                    elif n==15: ori=0
-                elif ori0==2:
-                    if False: pass
-                    elif n==2: ori=1
-                    elif n==3: ori=1
-                    elif n==7: ori=1
-                    elif n==5: ori=1
-                    elif n==4: ori=1
-                    elif n==0: ori=1
-                    elif n==1: ori=1
-                    elif n==6: ori=1
-            elif m=='Y':
-                if False: pass
-                elif ori0==0:
-                    if False: pass
-                    elif n==1: ori=2
-                    elif n==4: ori=2
-                    elif n==6: ori=2
-                    elif n==10: ori=1
-                    elif n==11: ori=1
-                    elif n==13: ori=1
-                    elif n==14: ori=1
-                    elif n==15: ori=1
-                    elif n==17: ori=1
-                    elif n==18: ori=1
-                    elif n==19: ori=1
-                    elif n==2: ori=2
-                    elif n==7: ori=2
-                    elif n==9: ori=1
-                    elif n==16: ori=1
-                    elif n==0: ori=2
-                    elif n==3: ori=2
-                    elif n==5: ori=2
-                    elif n==12: ori=1
-                    elif n==8: ori=1
-                elif ori0==1:
-                    if False: pass
-                    elif n==0: ori=1
-                    elif n==5: ori=1
-                    elif n==8: ori=0
-                    elif n==9: ori=0
-                    elif n==12: ori=0
-                    elif n==16: ori=0
-                    elif n==6: ori=1
-                    elif n==11: ori=0
-                    elif n==13: ori=0
-                    elif n==14: ori=0
-                    elif n==7: ori=1
-                    elif n==10: ori=0
-                    elif n==17: ori=0
-                    elif n==1: ori=1
-                    elif n==2: ori=1
-                    elif n==18: ori=0
-                    elif n==4: ori=1
-                    elif n==3: ori=1
-                    elif n==19: ori=0
-                    elif n==15: ori=0
-                elif ori0==2:
-                    if False: pass
-                    elif n==2: ori=0
-                    elif n==3: ori=0
-                    elif n==7: ori=0
-                    elif n==5: ori=0
-                    elif n==4: ori=0
-                    elif n==0: ori=0
-                    elif n==1: ori=0
-                    elif n==6: ori=0
-            elif m=='Z':
-                if False: pass
-                elif ori0==0:
-                    if False: pass
-                    elif n==1: ori=1
-                    elif n==4: ori=1
-                    elif n==6: ori=1
-                    elif n==10: ori=0
-                    elif n==11: ori=1
-                    elif n==13: ori=0
-                    elif n==14: ori=0
-                    elif n==15: ori=0
-                    elif n==17: ori=0
-                    elif n==18: ori=0
-                    elif n==19: ori=1
-                    elif n==2: ori=1
-                    elif n==7: ori=1
-                    elif n==9: ori=0
-                    elif n==16: ori=1
-                    elif n==0: ori=1
-                    elif n==3: ori=1
-                    elif n==5: ori=1
-                    elif n==12: ori=0
-                    elif n==8: ori=1
-                elif ori0==1:
-                    if False: pass
-                    elif n==0: ori=0
-                    elif n==5: ori=0
-                    elif n==8: ori=0
-                    elif n==9: ori=1
-                    elif n==12: ori=1
-                    elif n==16: ori=0
-                    elif n==6: ori=0
-                    elif n==11: ori=0
-                    elif n==13: ori=1
-                    elif n==14: ori=1
-                    elif n==7: ori=0
-                    elif n==10: ori=1
-                    elif n==17: ori=1
-                    elif n==1: ori=0
-                    elif n==2: ori=0
-                    elif n==18: ori=1
-                    elif n==4: ori=0
-                    elif n==3: ori=0
-                    elif n==19: ori=0
-                    elif n==15: ori=1
-                elif ori0==2:
-                    if False: pass
-                    elif n==2: ori=2
-                    elif n==3: ori=2
-                    elif n==7: ori=2
-                    elif n==5: ori=2
-                    elif n==4: ori=2
-                    elif n==0: ori=2
-                    elif n==1: ori=2
-                    elif n==6: ori=2
-
-            state[l] = state0[n]%N + N*ori
-        else:
-            state[n] = state0[n]
-            
+@njit(cache=True)
+def _unrank_perm(r, n):
+    'Permutation of length n with Lehmer rank r, and its parity'
+    digits = np.zeros(n, dtype=np.int64)
+    for i in range(n-1, -1, -1):
+        digits[i] = r % (n-i)
+        r //= (n-i)
+    free = np.ones(n, dtype=np.bool_)
+    p = np.empty(n, dtype=np.int64)
+    for i in range(n):
+        k = digits[i]
+        for j in range(n):
+            if free[j]:
+                if k == 0:
+                    p[i] = j
+                    free[j] = False
+                    break
+                k -= 1
+    return p, np.sum(digits) % 2
+
+
+@njit(cache=True)
+def _rank(state):
+    cp, _ = _rank_perm(state[:8] % 8)
+    co = 0
+    for n in range(7):
+        co = 3*co + state[n] // 8
+    ep, _ = _rank_perm(state[8:] % 12)
+    eo = 0
+    for n in range(8, 19):
+        eo = 2*eo + state[n] // 12
+    return cp * 3**7 + co, (ep // 2) * 2**11 + eo
+
+
+@njit(cache=True)
+def _unrank(ckey, ekey, chirality):
+    state = np.empty(20, dtype=byte)
+    cp, parity = _unrank_perm(ckey // 3**7, 8)
+    co, twist = ckey % 3**7, 0
+    for n in range(6, -1, -1):
+        state[n] = 8*(co % 3) + cp[n]
+        twist += (co % 3) * chirality[n]
+        co //= 3
+    state[7] = 8*((-twist * chirality[7]) % 3) + cp[7]
+    
+    # the last two edges are given by the parity, which has to be the same as for the corners
+    ep, eparity = _unrank_perm(2*(ekey // 2**11), 12)
+    if eparity != parity:
+        ep, eparity = _unrank_perm(2*(ekey // 2**11) + 1, 12)
+    eo, flip = ekey % 2**11, 0
+    for n in range(18, 7, -1):
+        state[n] = 12*(eo % 2) + ep[n-8]
+        flip += eo % 2
+        eo //= 2
+    state[19] = 12*(flip % 2) + ep[11]
     return state
 
 
+@njit(cache=True, parallel=True)
+def _rank_batch(states):
+    keys = np.empty((len(states), 2), dtype=np.uint64)
+    for b in prange(len(states)):
+        ckey, ekey = _rank(states[b])
+        keys[b, 0] = ckey
+        keys[b, 1] = ekey
+    return keys
 
-_state_types = set()
 
-def apply(state, m):
-    global _state_types
-    if not (type(state), type(m)) in _state_types:
-        ##print('apply got new input types:', (type(state), type(m)))
-        _state_types.add((type(state), type(m)))
-        
-    for mm in m:
-        state = _apply(state, mm)
+@njit(cache=True, parallel=True)
+def _unrank_batch(keys, chirality):
+    states = np.empty((len(keys), 20), dtype=byte)
+    for b in prange(len(keys)):
+        states[b] = _unrank(np.int64(keys[b, 0]), np.int64(keys[b, 1]), chirality)
+    return states
+
+
+def rank(state):
+    '''Unique number of the state in 0..n_states-1'''
+    ckey, ekey = _rank(np.asarray(state, dtype='uint8'))
+    return int(ckey) * n_edgekeys + int(ekey)
+
+
+def unrank(r):
+    '''State with the number r, inverse of `rank`'''
+    return _unrank(int(r) // n_edgekeys, int(r) % n_edgekeys, _chirality)
+
+
+def rank_batch(states):
+    '''Keys of a Bx20 array of states as a Bx2 array of (corner key, edge key)'''
+    return _rank_batch(np.asarray(states, dtype='uint8'))
+
+
+def unrank_batch(keys):
+    '''States of a Bx2 array of (corner key, edge key), inverse of `rank_batch`'''
+    return _unrank_batch(np.asarray(keys, dtype='uint64'), _chirality)
+
+
+
+
+# Symmetries of the cube: the 24 rotations and the 24 rotations followed by a mirroring. Applying a symmetry s moves the piece at
+# position n to position pos[s, n], its orientation o (of value v = N*o + colors) becomes ori[s, n, v] and the colors are relabeled
+# to relabel[s, colors] (first 8 entries for the corners, the others for the edges), such that the center pieces stay in standard colors.
+_num_augment = 24 # only rotations for augmentation
+num_symmetries = 48
+
+
+def _generate_symmetries():
+    '''Generates the symmetry tables by following labelled stickers and cubes with identical pieces through each symmetry'''
+    symmetries = cube_rotations()
+    symmetries += [ ms + 'i' for ms in symmetries ]
+    
+    sticker2piece = np.zeros(6*3*3, dtype='int64') # position of the piece a sticker belongs to
+    for n in range(8):
+        sticker2piece[_corner_stickers[n]] = n
+    for n in range(12):
+        sticker2piece[_edge_stickers[n]] = 8 + n
+    
+    cube = RubiksCube()
+    pos = np.zeros((num_symmetries, 20), dtype='int64')
+    ori = np.zeros((num_symmetries, 20, 24), dtype='uint8')
+    relabel = np.zeros((num_symmetries, 20), dtype='uint8')
+    for s, ms in enumerate(symmetries):
+        # positions: which piece's sticker arrives at the first sticker of position l
+        cube.fromfaces(np.arange(6*3*3).reshape((6,3,3)))
+        cube.rotate(ms)
+        faces = cube.getfaces().flatten()
+        for l in range(20):
+            sticker = _corner_stickers[l, 0] if l<8 else _edge_stickers[l-8, 0]
+            pos[s, sticker2piece[faces[sticker]]] = l
         
-    return state
\ No newline at end of file
+        # orientations and colors: all pieces of the cube have value v
+        for v in range(24):
+            cube.frompieces(np.full(20, v, dtype='uint8'))
+            cube.rotate(ms)
+            cube.colornormalization()
+            state = cube.getpieces()
+            for n in range(20):
+                N = 8 if n<8 else 12
+                ori[s, n, v] = state[pos[s, n]] // N
+                relabel[s, v%N + (0 if n<8 else 8)] = state[pos[s, n]] % N
+    return dict(pos=pos, ori=ori, relabel=relabel)
+
+
+@njit(cache=True)
+def _apply_symmetry(state0, s, pos, ori, relabel):
+    state = np.empty(20, dtype=byte)
+    for n in range(20):
+        N = 8 if n<8 else 12
+        v = state0[n]
+        state[pos[s,n]] = N*ori[s,n,v] + relabel[s, v%N + (0 if n<8 else 8)]
+    return state
+
+
+@njit(cache=True, parallel=True)
+def _apply_symmetry_batch(states, ss, pos, ori, relabel):
+    res = np.empty_like(states)
+    for b in prange(len(states)):
+        res[b] = _apply_symmetry(states[b], ss[b], pos, ori, relabel)
+    return res
+
+
+@njit(cache=True, parallel=True)
+def _canonicalize(states, pos, ori, relabel):
+    res = np.empty_like(states)
+    syms = np.empty(len(states), dtype=np.int64)
+    for b in prange(len(states)):
+        best_c, best_e = _rank(states[b])
+        res[b] = states[b]
+        syms[b] = 0
+        for s in range(1, len(pos)):
+            state = _apply_symmetry(states[b], s, pos, ori, relabel)
+            ckey, ekey = _rank(state)
+            if ckey < best_c or (ckey == best_c and ekey < best_e):
+                best_c, best_e = ckey, ekey
+                res[b] = state
+                syms[b] = s
+    return res, syms
+
+
+def _symmetries():
+    '''Symmetry tables (pos, ori, relabel), loaded on first use'''
+    tables = load_tables('pieces_symmetries', _generate_symmetries)
+    return tables['pos'], tables['ori'], tables['relabel']
+
+
+def apply_symmetry(states, ss):
+    '''Applies the symmetries ss (vector of B indices in 0..47, or one index for all) to a Bx20 array of states'''
+    states = np.asarray(states, dtype='uint8')
+    ss = np.broadcast_to(np.asarray(ss, dtype='int64'), (len(states),))
+    return _apply_symmetry_batch(states, ss, *_symmetries())
+
+
+def canonicalize(states, return_symmetries=False):
+    '''Maps each state of a Bx20 array to the representative of its symmetry class, which is the state with minimal rank
+    over the 48 symmetries. If `return_symmetries`, the indices of the applied symmetries are returned as well.'''
+    res, syms = _canonicalize(np.asarray(states, dtype='uint8'), *_symmetries())
+    if return_symmetries:
+        return res, syms
+    return res
+
+
+def random_states(n, seed=None):
+    '''Draws n states uniformly from all 4.3e19 states, e. g. for evaluation instead of scrambling with 1000 moves.
+    Random corner and edge keys are unranked, i. e. the permutations are random with matching parity and the
+    orientations are random except for the last corner and edge. seed: seed or np.random.Generator'''
+    rng = np.random.default_rng(seed)
+    keys = np.stack([ rng.integers(0, n_cornerkeys, n), rng.integers(0, n_edgekeys, n) ], axis=1)
+    return unrank_batch(keys)
@@ -0,0 +1,77 @@
+'''
+Distillation of a trained Net or Net2 (teacher) into the small Net_Small (student), which is much cheaper to evaluate
+in the search on the cpu. The student is trained on the values of the teacher on freshly scrambled states.
+    teacher = load_net('data/rubik_ep32_annealed.dat')
+    student = distill(teacher, steps=20000)
+    print(compare(teacher, student))
+    torch.save(student.state_dict(), 'data/rubik_small.dat')
+'''
+
+from time import perf_counter
+
+import torch
+from net import *
+
+
+def distill_states(n, maxdepth=30, p_random=0.1, seed=None):
+    '''n training states: scrambles with a uniformly drawn depth 1..maxdepth and a fraction p_random of uniformly random
+    states (as the cubes scrambled by 1000 moves of the benchmark)'''
+    rng = np.random.default_rng(seed)
+    nrandom = rng.binomial(n, p_random)
+    states, _ = scramble(n - nrandom, rng.integers(1, maxdepth+1, n - nrandom), seed=rng.integers(2**63))
+    return np.concatenate([states, random_states(nrandom, seed=rng)])
+
+
+def distill(teacher, student=None, steps=10000, batchsize=1024, lr=1e-3, maxdepth=30, p_random=0.1, seed=0,
+            verbose=True):
+    '''Trains student (default: a new Net_Small) to predict the values of teacher. The learning rate decays with a
+    cosine schedule from lr to 0 over the steps. Returns the student.'''
+    device = next(teacher.parameters()).device
+    if student is None:
+        student = Net_Small()
+    student = student.to(device).train()
+    teacher.eval()
+    optimizer = torch.optim.Adam(student.parameters(), lr=lr)
+    scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, steps)
+    rng = np.random.default_rng(seed)
+    t0 = perf_counter()
+    losses = []
+    for step in range(steps):
+        states = distill_states(batchsize, maxdepth, p_random, seed=rng.integers(2**63))
+        x = torch.from_numpy(states).to(device)
+        with torch.no_grad():
+            target = teacher(x, policy=False)
+        v = student(x)
+        loss = F.mse_loss(v, target) + F.l1_loss(v, target)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        scheduler.step()
+        student.iter += 1
+        losses.append(loss.item())
+        if verbose and (step+1) % 500 == 0:
+            print(f'Step {step+1}, loss {np.mean(losses[-500:]):.4f}, {perf_counter()-t0:.0f} s')
+    return student.eval()
+
+
+def compare(teacher, student, n=10000, maxdepth=30, batchsize=120, seed=12345):
+    '''Compares the values of student and teacher on n new states and the evaluation speed at the given batch size
+    (120 = 12 children of a search batch of 10 nodes) in torch.inference_mode'''
+    from rubiks_benchmark import timeit
+    device = next(teacher.parameters()).device
+    states = distill_states(n, maxdepth, seed=seed)
+    vt = predict(teacher, states)[:,0]
+    vs = predict(student, states)[:,0]
+    res = dict(mae=float(np.mean(np.abs(vs - vt))), max_error=float(np.max(np.abs(vs - vt))),
+               corr=float(np.corrcoef(vs, vt)[0,1]))
+    # order of the 12 children as seen by the search: how often is the best child of the teacher also the best of the student
+    children = apply_all_moves(states[:1000]).reshape(-1, 20)
+    ct, cs = predict(teacher, children)[:,0].reshape(-1, 12), predict(student, children)[:,0].reshape(-1, 12)
+    res['best_child_agreement'] = float(np.mean(np.argmin(ct, 1) == np.argmin(cs, 1)))
+    x = torch.from_numpy(states[:batchsize]).to(device)
+    for name, net in (('teacher', teacher), ('student', student)):
+        def f():
+            with torch.inference_mode():
+                net(x, policy=False)
+        res[f'{name}_states_per_s'] = float(batchsize / np.median(timeit(f, device)))
+    return res
@@ -0,0 +1,232 @@
+'''
+Evaluator which collects the states of many concurrent solves (threads, asyncio tasks or other processes via a unix
+socket) into large batches, evaluates them in one forward pass and returns the results to the callers.
+    evaluator = BatchEvaluator(lambda s: predict(net, s)[:,0])
+    values = evaluator.evaluate(states)                  # from any thread
+    values = await evaluator.evaluate_async(states)      # from asyncio tasks
+    serve(evaluator, '/tmp/rubiks.sock')                 # share the net with other processes, they use
+    values = RemoteEvaluator('/tmp/rubiks.sock').evaluate(states)
+'''
+
+import os
+import queue
+import socket
+import struct
+import asyncio
+import threading
+import socketserver
+from time import perf_counter
+from concurrent.futures import Future, InvalidStateError
+
+import numpy as np
+
+
+class BatchEvaluator:
+    '''Evaluates pieces states (b, 20) with fn in large batches. fn takes a uint8 array (B, 20) and returns an array with
+    leading dimension B, e. g. the values. A batch is evaluated as soon as max_batch states are waiting or the oldest
+    request waited max_latency seconds.'''
+    def __init__(self, fn, max_batch=1024, max_latency=0.002):
+        self.fn = fn
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.requests = queue.Queue()
+        self.lock = threading.Lock()
+        self.closed = False
+        self.nbatches = 0 # statistics: number of forward passes and evaluated states
+        self.nstates = 0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, states):
+        'Puts the states into the next batch and returns a concurrent.futures.Future of the result'
+        future = Future()
+        states = np.ascontiguousarray(states, dtype='uint8').reshape(-1, 20)
+        with self.lock:
+            if self.closed:
+                raise RuntimeError('BatchEvaluator is closed')
+            self.requests.put((states, future))
+        return future
+
+    def evaluate(self, states):
+        'Blocking evaluation of the states'
+        return self.submit(states).result()
+
+    async def evaluate_async(self, states):
+        'Evaluation of the states for asyncio tasks'
+        return await asyncio.wrap_future(self.submit(states))
+
+    def close(self):
+        'Evaluates the pending requests and stops the worker thread, later calls of submit raise a RuntimeError'
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.requests.put(None)
+        self.thread.join()
+
+    def _run(self):
+        batch, n = [], 0
+        while True:
+            if not batch:
+                item = self.requests.get()
+                deadline = perf_counter() + self.max_latency
+            else:
+                timeout = deadline - perf_counter()
+                try:
+                    item = self.requests.get(timeout=timeout) if n < self.max_batch and timeout > 0 else False
+                except queue.Empty:
+                    item = False
+            if item is None and not batch:
+                return
+            if item: # requests which were cancelled by the caller (e. g. a timeout of evaluate_async) are dropped
+                if item[1].set_running_or_notify_cancel():
+                    batch.append(item)
+                    n += len(item[0])
+                continue
+            if item is None:
+                self.requests.put(None) # finish this batch, then stop
+            self._evaluate(batch, n)
+            batch, n = [], 0
+
+    def _evaluate(self, batch, n):
+        try:
+            result = self.fn(np.concatenate([ states for states, _ in batch ]))
+            self.nbatches += 1
+            self.nstates += n
+            results, k = [], 0
+            for states, _ in batch:
+                results.append(result[k:k+len(states)])
+                k += len(states)
+        except Exception as e:
+            for _, future in batch:
+                _resolve(future, exception=e)
+            return
+        for (_, future), r in zip(batch, results):
+            _resolve(future, result=r)
+
+
+def _resolve(future, result=None, exception=None):
+    try:
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+    except InvalidStateError: # already resolved or cancelled
+        pass
+
+
+# Protocol of the unix socket: the client sends the number of states b (uint32) and the states (b*20 bytes). The server
+# answers with a status (uint32). If it is 0, b and the number of floats per state m (2 x uint32) and the results
+# (b*m float32) follow, otherwise the length of an error message (uint32) and the message (utf-8), which the client raises.
+
+def _recv(sock, n):
+    buf = bytearray(n)
+    view = memoryview(buf)
+    while n > 0:
+        k = sock.recv_into(view, n)
+        if k == 0:
+            raise ConnectionError('Connection closed')
+        view = view[k:]
+        n -= k
+    return buf
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        while True:
+            try:
+                b, = struct.unpack('<I', _recv(self.request, 4))
+            except ConnectionError:
+                return
+            try:
+                states = np.frombuffer(_recv(self.request, 20*b), dtype='uint8').reshape(b, 20)
+            except ConnectionError:
+                return
+            try:
+                if b == 0:
+                    result = np.zeros((0, 1), dtype='float32')
+                else:
+                    result = np.ascontiguousarray(self.server.evaluator.evaluate(states), dtype='float32').reshape(b, -1)
+                answer = struct.pack('<III', 0, *result.shape) + result.tobytes()
+            except Exception as e:
+                message = f'{type(e).__name__}: {e}'.encode()
+                answer = struct.pack('<II', 1, len(message)) + message
+            try:
+                self.request.sendall(answer)
+            except OSError:
+                return
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(evaluator, path, background=True):
+    '''Serves the evaluator on the unix socket path, one thread per connection. Returns the server (server.shutdown()
+    stops it) if background, otherwise serves until server.shutdown() is called by another thread. The socket is closed
+    and its path removed when the server stops.'''
+    if os.path.exists(path):
+        os.remove(path)
+    server = _Server(path, _Handler)
+    server.evaluator = evaluator
+    if background:
+        threading.Thread(target=_serve, args=(server, path), daemon=True).start()
+    else:
+        _serve(server, path)
+    return server
+
+
+def _serve(server, path):
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if os.path.exists(path):
+            os.remove(path)
+
+
+class RemoteError(RuntimeError):
+    'Exception raised by the evaluation on the server of a RemoteEvaluator'
+
+
+class RemoteEvaluator:
+    '''Client of an evaluator served by `serve`, with the same interface as BatchEvaluator. Each thread uses its own
+    connection, so that its requests are batched together with those of the other threads and processes.'''
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+
+    def _socket(self):
+        sock = getattr(self.local, 'sock', None)
+        if sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(self.path)
+            self.local.sock = sock
+        return sock
+
+    def evaluate(self, states):
+        '''Evaluates the states on the server. Errors of the server are raised as RemoteError, after a connection error
+        the next call opens a new connection.'''
+        states = np.ascontiguousarray(states, dtype='uint8').reshape(-1, 20)
+        try:
+            sock = self._socket()
+            sock.sendall(struct.pack('<I', len(states)) + states.tobytes())
+            status, = struct.unpack('<I', _recv(sock, 4))
+            if status != 0:
+                length, = struct.unpack('<I', _recv(sock, 4))
+                raise RemoteError(_recv(sock, length).decode())
+            b, m = struct.unpack('<II', _recv(sock, 8))
+            result = np.frombuffer(_recv(sock, 4*b*m), dtype='float32').reshape(b, m)
+        except OSError:
+            self._reset()
+            raise
+        return result[:,0] if m == 1 else result
+
+    def _reset(self):
+        sock = getattr(self.local, 'sock', None)
+        self.local.sock = None
+        if sock is not None:
+            sock.close()
+
+    async def evaluate_async(self, states):
+        return await asyncio.get_running_loop().run_in_executor(None, self.evaluate, states)
@@ -0,0 +1,71 @@
+'''
+Export of a trained Net or Net2 into a TorchScript (.pt) or ONNX (.onnx) file, which only contains the value head or the
+value and the policy head. The files are evaluated by rubiks_runtime.py without the training code.
+'''
+
+import copy
+import torch
+from torch import nn
+from typing import Tuple
+
+from net import *
+
+
+class ValueHeuristic(nn.Module):
+    '''Value head of Net or Net2 for pieces states (b, 20) with dtype uint8.
+    The first layer is stored as embedding table (see embed_pieces). onnx: sum the rows by a gather (exportable to
+    ONNX) instead of F.embedding_bag (faster in torch).'''
+    def __init__(self, net, onnx=False):
+        super().__init__()
+        self.onnx = onnx
+        self.register_buffer('embedding', net.shared[0].weight.detach().t().contiguous().cpu())
+        self.register_buffer('bias', net.shared[0].bias.detach().clone().cpu())
+        self.register_buffer('offsets', torch.arange(0, oh_len, shape_state[1]))
+        self.trunk = copy.deepcopy(net.shared[1:]).cpu()
+        self.valuehead = copy.deepcopy(net.valuehead).cpu()
+
+    def features(self, x):
+        idx = x.long() + self.offsets
+        if self.onnx:
+            h = self.embedding[idx].sum(1)
+        else:
+            h = F.embedding_bag(idx, self.embedding, mode='sum')
+        return self.trunk(h + self.bias)
+
+    def forward(self, x):
+        return 10*self.valuehead(self.features(x))
+
+
+class ValuePolicyHeuristic(ValueHeuristic):
+    'Value and policy (log probabilities of the 12 moves) of Net or Net2 for pieces states (b, 20) with dtype uint8'
+    def __init__(self, net, onnx=False):
+        super().__init__(net, onnx=onnx)
+        self.policyhead = copy.deepcopy(net.policyhead).cpu()
+
+    def forward(self, x) -> Tuple[torch.Tensor, torch.Tensor]:
+        h = self.features(x)
+        return 10*self.valuehead(h), self.policyhead(h)
+
+
+def export(net, fn, policy=False):
+    '''Exports net (Net or Net2) to the file fn, as ONNX if fn ends with .onnx and as TorchScript otherwise.
+    policy: also export the policy head'''
+    onnx = fn.endswith('.onnx')
+    cls = ValuePolicyHeuristic if policy else ValueHeuristic
+    model = cls(net, onnx=onnx).eval()
+    for p in model.parameters():
+        p.requires_grad_(False)
+    if onnx:
+        x = torch.zeros((2, 20), dtype=torch.uint8)
+        names = ['value', 'policy'] if policy else ['value']
+        torch.onnx.export(model, (x,), fn, input_names=['states'], output_names=names, dynamo=False,
+                          dynamic_axes={ name: {0: 'b'} for name in ['states'] + names })
+    else:
+        torch.jit.save(torch.jit.freeze(torch.jit.script(model)), fn)
+
+
+def export_checkpoint(fn_in, fn_out, cls=Net, policy=False):
+    '''Loads a checkpoint saved by torch.save(net.state_dict(), fn_in), e. g. data/rubik_ep32_annealed.dat, and exports it'''
+    net = cls().cpu()
+    net.load_state_dict(torch.load(fn_in, map_location='cpu'))
+    export(net.eval(), fn_out, policy=policy)
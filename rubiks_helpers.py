@@ -5,15 +5,28 @@ Helper functions
 
 from rubiks_cube import *
 #from rubiks_cube_faces import *
+import os
 import numpy as np
 import torch
 
 from numba import jit, njit
 from numba.types import byte
     
-GPU = torch.cuda.is_available()
+# Device of the networks and of the tensors created by numpy2torch. Defaults to cuda if available, can be changed by
+# set_device (before the networks are created) or the environment variable RUBIKS_DEVICE, e. g. RUBIKS_DEVICE=cpu
+device = torch.device(os.environ.get('RUBIKS_DEVICE', 'cuda' if torch.cuda.is_available() else 'cpu'))
+GPU = device.type == 'cuda'
 if not GPU:
     print('NOT USING GPU!')
+
+def set_device(d):
+    'Sets the device (e. g. "cpu", "cuda", "cuda:1") for all networks and tensors created afterwards'
+    global device, GPU
+    device = torch.device(d)
+    GPU = device.type == 'cuda'
+
+def get_device():
+    return device
     
 
 def policy2oh(p, n=12):
@@ -27,9 +40,12 @@ def policy2oh(p, n=12):
 def numpy2torch(x, dtype='float32'):
     'Converts a numpy array to a torch array'
     x = torch.from_numpy(x.astype(dtype))
-    if GPU:
-        x = x.cuda()
-    return x
+    return x.to(device)
+
+def pieces2torch(x):
+    'Converts a batch of pieces states (b, 20) to a uint8 torch array, which the nets take without one hot conversion'
+    x = torch.from_numpy(np.ascontiguousarray(x, dtype='uint8'))
+    return x.to(device)
 
 def torch2numpy(x):
     'Converts a torch array to a numpy array'
@@ -61,17 +77,29 @@ def argmax(list, num):
     return res
 
 
-def update_mt(mt, n, tau):
-    '''updates the mean teacher by the network
+def update_mt(mt, n, tau, step=None, every=1):
+    '''updates the mean teacher by the network, in place: mt = tau*mt + (1-tau)*n for all parameters and floating point
+    buffers (other buffers like num_batches_tracked are copied from n)
     mt: Mean teacher network
     n: Target network
-    tau: Update constanst like 0.9'''
-    mtdict = mt.state_dict()
-    ndict = n.state_dict()
-    for k in mtdict.keys():
-        mtdict[k] = tau * mtdict[k] + (1-tau) * ndict[k]
-    mt.load_state_dict(mtdict)
-    
+    tau: Update constanst like 0.9
+    step, every: update only in every `every`-th step (with tau**every, i. e. the same time constant), step is the
+        training step and required if every > 1'''
+    if every > 1:
+        assert step is not None, 'update_mt needs the training step if every > 1'
+        if step % every != 0:
+            return
+        tau = tau**every
+    mts, ns = [], []
+    with torch.no_grad():
+        for a, b in zip(list(mt.parameters()) + list(mt.buffers()), list(n.parameters()) + list(n.buffers())):
+            if a.is_floating_point():
+                mts.append(a)
+                ns.append(b)
+            else:
+                a.copy_(b)
+        torch._foreach_mul_(mts, tau)
+        torch._foreach_add_(mts, ns, alpha=1-tau)
     
     
 def SolutionLink(moves):
@@ -125,4 +153,283 @@ class SolvingQueue:
         self.items.remove(hashable(item))
         return item
     def __len__(self):
-        return len(self.items)
\ No newline at end of file
+        return len(self.items)
+
+
+# Open list of the solver: the nodes are kept in numpy arrays and the queues are heaps of node indices. The priority
+# h + t*g of a node in the queue with weight t is computed from the node arrays, ties are broken by the node index,
+# i. e. by the order of insertion.
+
+@njit(cache=True)
+def _slot(ckey, ekey, mask):
+    h = ckey * np.uint64(0x9E3779B97F4A7C15) ^ ekey * np.uint64(0xC2B2AE3D27D4EB4F)
+    return np.int64((h ^ (h >> np.uint64(29))) & mask)
+
+
+@njit(cache=True)
+def _insert(table, ckeys, ekeys, kc, ke, n):
+    '''Inserts the keys (kc, ke) into the hash table (linear probing, entries are node indices or -1), skipping keys which
+    are already known. The new keys get the node indices n, n+1, ... and are written to ckeys, ekeys. Returns the
+    positions of the new keys in kc, ke.'''
+    mask = np.uint64(len(table) - 1)
+    new = np.empty(len(kc), dtype=np.int64)
+    k = 0
+    for i in range(len(kc)):
+        s = _slot(kc[i], ke[i], mask)
+        while True:
+            j = table[s]
+            if j < 0:
+                table[s] = n + k
+                ckeys[n+k] = kc[i]
+                ekeys[n+k] = ke[i]
+                new[k] = i
+                k += 1
+                break
+            if ckeys[j] == kc[i] and ekeys[j] == ke[i]:
+                break
+            s = (s + 1) & np.int64(mask)
+    return new[:k]
+
+
+@njit(cache=True)
+def _rehash(table, ckeys, ekeys, n):
+    mask = np.uint64(len(table) - 1)
+    table[:] = -1
+    for j in range(n):
+        s = _slot(ckeys[j], ekeys[j], mask)
+        while table[s] >= 0:
+            s = (s + 1) & np.int64(mask)
+        table[s] = j
+
+
+@njit(cache=True)
+def _less(heap, i, j, t, g, h):
+    a, b = heap[i], heap[j]
+    pa, pb = h[a] + t*g[a], h[b] + t*g[b]
+    return pa < pb or (pa == pb and a < b)
+
+
+@njit(cache=True)
+def _sift_down(heap, i, size, t, g, h):
+    while True:
+        j = 2*i + 1
+        if j >= size:
+            return
+        if j + 1 < size and _less(heap, j+1, j, t, g, h):
+            j += 1
+        if not _less(heap, j, i, t, g, h):
+            return
+        heap[i], heap[j] = heap[j], heap[i]
+        i = j
+
+
+@njit(cache=True)
+def _heap_push(heaps, sizes, nodes, ts, g, h):
+    'Pushes the nodes into all heaps'
+    for q in range(len(ts)):
+        heap = heaps[q]
+        for k in range(len(nodes)):
+            i = sizes[q]
+            heap[i] = nodes[k]
+            sizes[q] += 1
+            while i > 0:
+                j = (i - 1) // 2
+                if not _less(heap, i, j, ts[q], g, h):
+                    break
+                heap[i], heap[j] = heap[j], heap[i]
+                i = j
+
+
+@njit(cache=True)
+def _heap_pop(heaps, sizes, q, ts, g, h, closed):
+    'Best open node of heap q (-1 if there is none). Entries of closed nodes are discarded on the way.'
+    heap = heaps[q]
+    while sizes[q] > 0:
+        node = heap[0]
+        sizes[q] -= 1
+        heap[0] = heap[sizes[q]]
+        _sift_down(heap, 0, sizes[q], ts[q], g, h)
+        if not closed[node]:
+            return node
+    return -1
+
+
+@njit(cache=True)
+def _heap_pop_many(heaps, sizes, ts, g, h, closed, q0, n, a, b):
+    '''Pops up to n open nodes, the k-th one out of heap (q0+k) % number of heaps, and closes them. Nodes with
+    g + a*h >= b are dropped. Returns the popped nodes and the number of dropped ones.'''
+    out = np.empty(n, dtype=np.int64)
+    k, dropped = 0, 0
+    while k < n:
+        node = _heap_pop(heaps, sizes, (q0 + k) % len(ts), ts, g, h, closed)
+        if node < 0:
+            break
+        closed[node] = True
+        if g[node] + a*h[node] < b:
+            out[k] = node
+            k += 1
+        else:
+            dropped += 1
+    return out[:k], dropped
+
+
+@njit(cache=True)
+def _compact(heap, size, t, g, h, closed):
+    'Removes the entries of closed nodes from the heap, returns its new size'
+    k = 0
+    for i in range(size):
+        if not closed[heap[i]]:
+            heap[k] = heap[i]
+            k += 1
+    for i in range(k//2 - 1, -1, -1):
+        _sift_down(heap, i, k, t, g, h)
+    return k
+
+
+class OpenList:
+    '''Array based version of SolvingQueue for the solver, which also is its node store. Node i has the state key
+    (ckeys[i], ekeys[i]) (as given by rank_batch), the index of the parent node, the last move (index in moves, -1 for
+    the root), the number of moves g and the value h, i. e. 28 bytes per node, and the path of a node is only
+    reconstructed when needed. There is one heap of node indices per weight t, in which the priority of a node is
+    h + penalty*t*g. A state is only inserted once (hash table of the keys), popped nodes are closed and their entries in
+    the other heaps are removed lazily or by compaction, as soon as they are the majority of a heap.
+    max_capacity: the arrays are not grown beyond this number of nodes unless more nodes are pushed (see evict)'''
+    def __init__(self, weights=(0, .2, .4, .6, .8), penalty=0.8, capacity=1024, max_capacity=None):
+        self.t = penalty * np.array(weights, dtype='float64')
+        self.nq = len(weights)
+        self.max_capacity = max_capacity
+        self.n = 0 # number of nodes
+        self.nopen = 0 # number of open nodes
+        self.sizes = np.zeros(self.nq, dtype='int64')
+        self.capacity = 0
+        self._allocate(capacity)
+
+    def _allocate(self, capacity):
+        'Resizes the arrays to capacity nodes and rebuilds the hash table'
+        fields = dict(ckeys=(capacity, 'uint64'), ekeys=(capacity, 'uint64'), parent=(capacity, 'int32'),
+                      move=(capacity, 'int8'), g=(capacity, 'int16'), h=(capacity, 'float32'),
+                      closed=(capacity, 'bool'), heaps=((self.nq, capacity), 'int32'))
+        for name, (shape, dtype) in fields.items():
+            a = np.empty(shape, dtype=dtype)
+            if self.capacity > 0:
+                old = getattr(self, name)
+                a[tuple(slice(0, k) for k in old.shape)] = old
+            setattr(self, name, a)
+        self.table = np.empty(1 << (2*capacity - 1).bit_length(), dtype='int32') # power of 2, at most half full
+        self.capacity = capacity
+        _rehash(self.table, self.ckeys, self.ekeys, self.n)
+
+    @staticmethod
+    def node_bytes(nq=5):
+        'Upper bound of the memory per node: the node arrays, one heap entry per queue and up to 4 slots of the hash table'
+        return 28 + 4*nq + 16
+
+    @property
+    def nbytes(self):
+        'Allocated memory in bytes'
+        return sum( a.nbytes for a in (self.ckeys, self.ekeys, self.parent, self.move, self.g, self.h, self.closed,
+                                       self.heaps, self.table) )
+
+    def push(self, keys, parents, moves, g, h):
+        '''Inserts the nodes with keys (b, 2), parent indices, moves, g and h (each (b,)) whose states are not yet in the
+        list. Returns the indices of the new nodes and their positions in the arguments.'''
+        if self.n + len(keys) > self.capacity:
+            capacity = self.capacity
+            while self.n + len(keys) > capacity:
+                capacity *= 2
+            if self.max_capacity is not None:
+                capacity = max(min(capacity, self.max_capacity), self.n + len(keys))
+            self._allocate(capacity)
+        keys = np.ascontiguousarray(keys, dtype='uint64')
+        new = _insert(self.table, self.ckeys, self.ekeys, keys[:,0], keys[:,1], self.n)
+        nodes = np.arange(self.n, self.n + len(new))
+        self.parent[nodes] = np.asarray(parents)[new]
+        self.move[nodes] = np.asarray(moves)[new]
+        self.g[nodes] = np.asarray(g)[new]
+        self.h[nodes] = np.asarray(h)[new]
+        self.closed[nodes] = False
+        _heap_push(self.heaps, self.sizes, nodes, self.t, self.g, self.h)
+        self.n += len(new)
+        self.nopen += len(new)
+        return nodes, new
+
+    def pop(self, q0, n, a=0., b=np.inf):
+        '''Takes up to n open nodes out of the list, the k-th one with the best priority of queue (q0+k) % nq. Nodes
+        with g + a*h >= b are closed but not returned. Returns the indices of the nodes (fewer than n if the list ran
+        empty).'''
+        nodes, dropped = _heap_pop_many(self.heaps, self.sizes, self.t, self.g, self.h, self.closed, q0, n, a, b)
+        self.nopen -= len(nodes) + dropped
+        for q in range(self.nq):
+            if self.sizes[q] > 2*self.nopen + 1024:
+                self.sizes[q] = _compact(self.heaps[q], self.sizes[q], self.t[q], self.g, self.h, self.closed)
+        return nodes
+
+    def evict(self, n):
+        '''Removes up to n open nodes without children (not the root) with the worst priorities, where a node is ranked
+        by its best position in any of the queues. As in SMA*, their parents are reopened with the best value of their
+        removed children plus one move, so that the removed states can be generated again. The remaining nodes are
+        renumbered (in the same order), i. e. node i becomes i - (number of removed nodes < i). Returns the sorted
+        indices of the removed nodes.'''
+        m = self.n
+        has_child = np.bincount(self.parent[1:m], minlength=m) > 0
+        candidates = np.flatnonzero(~self.closed[:m] & ~has_child)
+        candidates = candidates[candidates > 0]
+        n = min(n, len(candidates))
+        if n <= 0:
+            return np.zeros(0, dtype='int64')
+        g, h = self.g[candidates], self.h[candidates]
+        rank = np.full(len(candidates), len(candidates))
+        for t in self.t:
+            order = np.lexsort((candidates, h + t*g))
+            r = np.empty(len(candidates), dtype='int64')
+            r[order] = np.arange(len(candidates))
+            rank = np.minimum(rank, r)
+        evicted = np.sort(candidates[np.argsort(-rank, kind='stable')[:n]])
+
+        # back up the values to the parents
+        best = np.full(m, np.inf, dtype='float32')
+        np.minimum.at(best, self.parent[evicted], self.h[evicted] + 1)
+        parents = np.flatnonzero(best < np.inf)
+        self.h[parents] = np.where(self.closed[parents], best[parents], np.minimum(self.h[parents], best[parents]))
+        self.closed[parents] = False
+
+        keep = np.ones(m, dtype='bool')
+        keep[evicted] = False
+        index = (np.cumsum(keep) - 1).astype('int32')
+        self.parent[:m] = np.where(self.parent[:m] >= 0, index[self.parent[:m]], -1)
+        for a in (self.ckeys, self.ekeys, self.parent, self.move, self.g, self.h, self.closed):
+            a[:m-n] = a[:m][keep]
+        self.n = m - n
+        _rehash(self.table, self.ckeys, self.ekeys, self.n)
+        nodes = np.flatnonzero(~self.closed[:self.n]).astype('int32')
+        self.nopen = len(nodes)
+        for q in range(self.nq):
+            self.heaps[q, :len(nodes)] = nodes
+            self.sizes[q] = _compact(self.heaps[q], len(nodes), self.t[q], self.g, self.h, self.closed)
+        return evicted
+
+    def keys(self, nodes):
+        'State keys (b, 2) of the nodes'
+        return np.stack([self.ckeys[nodes], self.ekeys[nodes]], 1)
+
+    def path(self, node):
+        'Indices of the moves from the root to the node'
+        ms = []
+        while self.parent[node] >= 0:
+            ms.append(int(self.move[node]))
+            node = self.parent[node]
+        return ms[::-1]
+
+    def __contains__(self, key):
+        'Whether a state with key (ckey, ekey) was inserted'
+        ckey, ekey = np.uint64(key[0]), np.uint64(key[1])
+        s = _slot(ckey, ekey, np.uint64(len(self.table) - 1))
+        while self.table[s] >= 0:
+            j = self.table[s]
+            if self.ckeys[j] == ckey and self.ekeys[j] == ekey:
+                return True
+            s = (s + 1) % len(self.table)
+        return False
+
+    def __len__(self):
+        return self.nopen
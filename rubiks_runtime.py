@@ -0,0 +1,38 @@
+'''
+Standalone runtime for the heuristic exported by rubiks_export.py. Only needs numpy and torch (TorchScript files) or
+onnxruntime (.onnx files), but not the training code.
+'''
+
+import numpy as np
+
+
+class HeuristicRuntime:
+    '''Loads an exported heuristic and evaluates pieces states (b, 20) with dtype uint8.
+    Returns the values (b,) or, if the policy was exported, a tuple of values (b,) and log probabilities (b, 12).
+    threads: number of cpu threads'''
+    def __init__(self, fn, threads=None):
+        self.onnx = fn.endswith('.onnx')
+        if self.onnx:
+            import onnxruntime
+            options = onnxruntime.SessionOptions()
+            if threads is not None:
+                options.intra_op_num_threads = threads
+            self.session = onnxruntime.InferenceSession(fn, options, providers=['CPUExecutionProvider'])
+        else:
+            import torch
+            self.torch = torch
+            if threads is not None:
+                torch.set_num_threads(threads)
+            self.model = torch.jit.load(fn, map_location='cpu').eval()
+
+    def __call__(self, states):
+        states = np.ascontiguousarray(states, dtype='uint8')
+        if self.onnx:
+            result = self.session.run(None, {'states': states})
+        else:
+            with self.torch.inference_mode():
+                result = self.model(self.torch.from_numpy(states))
+            result = [ r.numpy() for r in result ] if isinstance(result, tuple) else [result.numpy()]
+        if len(result) == 1:
+            return result[0][:,0]
+        return result[0][:,0], result[1]
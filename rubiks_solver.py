@@ -0,0 +1,261 @@
+'''
+Weighted A* search with a heuristic (e. g. the value of a network), as solve() of the notebooks.
+    solver = Solver(NetHeuristic(load_net('data/rubik_ep32_annealed.dat')), maxlen=35)
+    res = solver.solve(shuffle(n=1000))
+    print(res['ms'], res['l'], res['trials'], res['time'], res['timings'])
+    results = solver.solve_many(random_states(1000))
+    solver = Solver(heuristic, trials=np.inf, max_bytes=2**30) # evicts nodes instead of running out of memory
+    solver = Solver(NetHeuristic(net, accumulators=True)) # children evaluated from the first layer of their parent
+'''
+
+from time import perf_counter
+
+import numpy as np
+from rubiks_cube_states import *
+from rubiks_helpers import OpenList
+
+
+class NetHeuristic:
+    '''Heuristic given by the value head of a network (Net, Net2, Net_Small, ...), evaluated in torch.inference_mode.
+    accumulators: only for Net and Net2, the solver keeps the first layer (accumulator) of the open nodes and evaluates
+        their children incrementally by `expand` (see net.expand)'''
+    def __init__(self, net, accumulators=False):
+        import torch
+        from net import predict, expand, pieces2torch
+        self.net = net
+        self.accumulators = accumulators
+        self.torch = torch
+        self.predict = predict
+        self._expand = expand
+        self.pieces2torch = pieces2torch
+    def __call__(self, states):
+        return self.predict(self.net, states)[:,0]
+    def expand(self, acc, states):
+        'Accumulators (b, 12, n) and values (b, 12) of the children of the states (b, 20) with accumulators acc (b, n)'
+        with self.torch.inference_mode():
+            acc, v = self._expand(self.net, acc, self.pieces2torch(states))
+        return acc, v[:,:,0].float().cpu().numpy()
+
+
+class Solver:
+    '''Solves cubes in pieces format by a weighted A* search.
+    heuristic: function (or object with a method evaluate, like BatchEvaluator) which maps states (b, 20) to the estimated
+        number of moves (b,), e. g. NetHeuristic(net) or HeuristicRuntime(fn)
+    batchsize: number of nodes which are expanded together, i. e. 12*batchsize states are evaluated at once
+    maxlen: maximal length of the solution
+    trials: maximal number of expanded nodes
+    penalty, weights: there is one queue per weight t, in which the priority of a node is v + penalty*t*len(moves).
+        The queues are used in turn.
+    len_estimate: a node is only expanded if len(moves) + len_estimate*v - 0.5 < maxlen (expected length of the solution)
+    hashtable, mashtable, hashed_depth: states near the solved state (state.tobytes() -> depth and -> moves from the
+        solved state), all states up to hashed_depth moves
+    max_nodes, max_bytes: memory budget of each search in nodes, or in bytes (converted by OpenList.node_bytes). If it
+        is exceeded, the worst open nodes are evicted down to evict_to times the budget, see OpenList.evict
+    acc_cache: number of accumulators of open nodes kept in memory (shared by the searches of solve_many), if the
+        heuristic uses accumulators. Missing ones are recomputed when the node is expanded.'''
+    def __init__(self, heuristic, batchsize=10, maxlen=100, trials=100000, penalty=0.8, weights=(0, .2, .4, .6, .8),
+                 len_estimate=0.8, hashtable=None, mashtable=None, hashed_depth=-1, max_nodes=None, max_bytes=None,
+                 evict_to=0.8, acc_cache=8192, verbose=0):
+        self.heuristic = heuristic
+        self.evaluate = heuristic.evaluate if hasattr(heuristic, 'evaluate') else heuristic
+        self.accumulators = getattr(heuristic, 'accumulators', False)
+        self.acc_cache = acc_cache
+        self.batchsize = batchsize
+        self.maxlen = maxlen
+        self.trials = trials
+        self.penalty = penalty
+        self.weights = weights
+        self.len_estimate = len_estimate
+        self.hashtable = hashtable if hashtable is not None else dict()
+        self.mashtable = mashtable if mashtable is not None else dict()
+        self.hashed_depth = hashed_depth
+        if max_bytes is not None:
+            max_nodes = min(max_nodes or np.inf, max_bytes // OpenList.node_bytes(len(weights)))
+        self.max_nodes = max_nodes
+        self.evict_to = evict_to
+        self.verbose = verbose
+
+    def penalties(self, v, l):
+        'Priorities of a node with value v and l moves in the queues'
+        return [ v + self.penalty*l*t for t in self.weights ]
+
+    def solve(self, state0):
+        '''Solves the cube state0. Returns a dictionary with
+        solved, ms (moves of the solution or -1), l (length of the solution or -1), trials (expanded nodes),
+        nodes (evaluated states), time (in s), timings (time of the phases select, expand, evaluate and queue),
+        memory (peak memory of the open list in bytes) and evicted (number of evicted nodes)'''
+        return self.solve_many([state0])[0]
+
+    def solve_many(self, states):
+        '''Solves many cubes together: in each step the nodes of all unfinished searches are expanded and their children
+        evaluated in one call of the heuristic (i. e. up to 12*batchsize*len(states) states). Finished searches are
+        retired, the others continue. Returns a list of dictionaries as solve. The time of the common expand and evaluate
+        phases is split among the searches by their number of expanded nodes.'''
+        t_start = perf_counter()
+        states = [ self._prepare(state) for state in states ]
+        if len(states) == 0:
+            return []
+        t = perf_counter()
+        vs = self.evaluate(np.array(states))
+        dt = (perf_counter() - t) / len(states)
+        cache = None
+        if self.accumulators:
+            from net import AccumulatorCache
+            cache = AccumulatorCache(self.heuristic.net, self.acc_cache) # keys (index of the search, node)
+        searches = [ _Search(self, state, float(v), t_start, cache, sid)
+                     for sid, (state, v) in enumerate(zip(states, vs)) ]
+        for search in searches:
+            search.res['timings']['evaluate'] += dt
+        active = searches
+
+        while active:
+            parents, nodes, counts = [], [], []
+            for search in active:
+                ps, ns = search.select()
+                parents.append(ps)
+                nodes.append(ns)
+                counts.append(len(ns))
+            if sum(counts) == 0:
+                active = [ search for search in active if not search.done ]
+                continue
+
+            t = perf_counter()
+            parents = np.concatenate(parents)
+            children = apply_all_moves(parents).reshape(-1, 20)
+            t_expand = perf_counter() - t
+
+            t = perf_counter()
+            if cache is None:
+                vs = self.evaluate(children)
+            else:
+                keys = [ (search.sid, node) for search, ns in zip(active, nodes) for node in ns ]
+                acc, vs = self.heuristic.expand(cache.pop(parents, keys), parents)
+                acc, vs = acc.reshape(len(children), -1), vs.reshape(-1)
+            t_evaluate = perf_counter() - t
+
+            k = 0
+            for search, ns, n in zip(active, nodes, counts):
+                if n == 0:
+                    continue
+                timings = search.res['timings']
+                timings['expand'] += t_expand * n / len(parents)
+                timings['evaluate'] += t_evaluate * n / len(parents)
+                search.push(children[12*k:12*(k+n)], ns, vs[12*k:12*(k+n)],
+                            None if cache is None else acc[12*k:12*(k+n)])
+                k += n
+            active = [ search for search in active if not search.done ]
+
+        return [ search.res for search in searches ]
+
+    def _prepare(self, state0):
+        state0 = np.asarray(state0)
+        if state0.shape != (20,):
+            state0 = oh2state(state0)
+        return state0.astype('uint8')
+
+
+class _Search:
+    '''State of the search for one cube (open list, which also stores the closed nodes, and result) of Solver.solve_many'''
+    def __init__(self, solver, state0, v0, t_start, cache=None, sid=0):
+        self.solver = solver
+        self.t_start = t_start
+        self.cache = cache # accumulators of the open nodes, keys (sid, node)
+        self.sid = sid
+        self.nq = len(solver.weights)
+        self.res = dict(solved=False, ms=-1, l=-1, trials=0, nodes=1, time=0., memory=0, evicted=0,
+                        timings=dict(select=0., expand=0., evaluate=0., queue=0.))
+        self.done = False
+        max_capacity = None if solver.max_nodes is None else int(solver.max_nodes) + 12*solver.batchsize
+        self.queue = OpenList(solver.weights, solver.penalty, capacity=min(1024, max_capacity or 1024),
+                              max_capacity=max_capacity)
+        self.queue.push(rank_batch(state0[None]), parents=[-1], moves=[-1], g=[0], h=[v0])
+
+    def finish(self, ms):
+        res = self.res
+        res['memory'] = self.queue.nbytes # the arrays never shrink
+        if ms is not None:
+            res.update(solved=True, ms=ms, l=len(ms))
+        res['time'] = perf_counter() - self.t_start
+        self.done = True
+        if self.cache is not None:
+            self.cache.remap(lambda key: None if key[0] == self.sid else key)
+        if self.solver.verbose >= 1:
+            if ms is None:
+                print(f'Aborting after {res["trials"]} trials!')
+            else:
+                print(f'Cube is solved after {len(ms)} moves and {res["trials"]} trials!')
+        return np.zeros((0, 20), dtype='uint8'), np.zeros(0, dtype='int64')
+
+    def moves(self, node):
+        'Moves from state0 to the node'
+        return ''.join( moves[m] for m in self.queue.path(node) )
+
+    def select(self):
+        '''Takes the next nodes out of the queue. Returns their states and node indices, or nothing if the search is
+        finished'''
+        t = perf_counter()
+        try:
+            return self._select()
+        finally:
+            self.res['timings']['select'] += perf_counter() - t
+
+    def _select(self):
+        solver, queue, res = self.solver, self.queue, self.res
+        hd, le = solver.hashed_depth, solver.len_estimate
+        if len(queue) == 0:
+            return self.finish(None)
+        bsize = min(solver.batchsize, len(queue)) # batch size is small at the beginning and can become bigger
+        # only nodes that fulfill the maxlen constraint, g + le*(v-hd) - 0.5 < maxlen - hd (expected vs. maximal length)
+        nodes = queue.pop(res['trials'] % self.nq, bsize, le, solver.maxlen - hd + le*hd + 0.5)
+        states = unrank_batch(queue.keys(nodes)) # the states are not stored in the queue
+        for node, state in zip(nodes, states):
+            if solver.verbose >= 2:
+                print(f'Iteration {res["trials"]}, Moves {self.moves(node)} applied, Value = {queue.h[node]}, '
+                      f'len(queue) = {len(queue)}!')
+            s = state.tobytes()
+            if s in solver.hashtable:
+                return self.finish(self.moves(node) + inverse_moves(solver.mashtable[s]))
+            if issolved(state):
+                return self.finish(self.moves(node))
+            res['trials'] += 1
+            if res['trials'] >= solver.trials:
+                return self.finish(None)
+        if len(nodes) < bsize: # queue ran empty
+            return self.finish(None)
+        return states, nodes
+
+    def push(self, children, parents, vs, acc=None):
+        '''Puts the evaluated children of the parent nodes into the queue, except for states which were already
+        reached, and their accumulators acc into the cache'''
+        t = perf_counter()
+        self.res['nodes'] += len(children)
+        parents = np.repeat(parents, 12)
+        nodes, new = self.queue.push(rank_batch(children), parents, np.tile(np.arange(12), len(parents)//12),
+                                     self.queue.g[parents] + 1, vs)
+        if self.cache is not None:
+            self.cache.put(children[new], acc[new], keys=[ (self.sid, node) for node in nodes ])
+        max_nodes = self.solver.max_nodes
+        if max_nodes is not None and self.queue.n > max_nodes:
+            evicted = self.queue.evict(self.queue.n - int(self.solver.evict_to * max_nodes))
+            self.res['evicted'] += len(evicted)
+            if self.cache is not None and len(evicted) > 0:
+                self.cache.remap(lambda key: self._renumber(key, evicted))
+            if self.solver.verbose >= 2:
+                print(f'Evicted nodes, {self.queue.n} nodes left, {self.res["evicted"]} evicted in total!')
+        self.res['timings']['queue'] += perf_counter() - t
+
+
+    def _renumber(self, key, evicted):
+        'Key of a cached accumulator after the nodes evicted (sorted) were removed from the open list'
+        sid, node = key
+        if sid != self.sid:
+            return key
+        i = np.searchsorted(evicted, node)
+        if i < len(evicted) and evicted[i] == node:
+            return None
+        return (sid, node - i)
+
+
+def solve(state0, heuristic, **kwargs):
+    'Solves the cube state0 with a Solver(heuristic, **kwargs), see Solver.solve'
+    return Solver(heuristic, **kwargs).solve(state0)
@@ -0,0 +1,33 @@
+'''
+Cache for the precomputed tables of the state modules (moves, augmentations, ...).
+The tables are generated once and saved as .npz files next to this module.
+'''
+
+import os
+import numpy as np
+
+version = 2 # increase whenever the generation of a table changes, old files are then ignored
+
+_dir = os.path.dirname(os.path.abspath(__file__))
+_loaded = dict()
+
+
+def load_tables(name, generate):
+    '''Returns the tables `name` as a dictionary of arrays. They are read from the file `{name}_v{version}.npz`,
+    if it does not exist they are created by `generate()` (which returns such a dictionary) and saved.'''
+    if name in _loaded:
+        return _loaded[name]
+    fn = os.path.join(_dir, f'{name}_v{version}.npz')
+    try:
+        with np.load(fn) as f:
+            tables = dict(f)
+    except (OSError, ValueError):
+        tables = generate()
+        try:
+            tmp = f'{fn}.{os.getpid()}.tmp.npz' # write and rename, so that parallel processes never read a half written file
+            np.savez(tmp, **tables)
+            os.replace(tmp, fn)
+        except OSError:
+            pass # e. g. read only directory, then the tables are generated in every process
+    _loaded[name] = tables
+    return tables
@@ -0,0 +1,103 @@
+'''
+Checks of the pieces format: perfect ranking of the states and symmetry tables. Run with pytest or
+python test_pieces.py
+'''
+
+import numpy as np
+from rubiks_cube_pieces import *
+from rubiks_cube_pieces import _chirality, _rank_perm
+
+
+def test_rank_roundtrip():
+    'unrank(rank(state)) is the state, for scrambled states and for the solved state'
+    states, _ = scramble(2000, np.arange(2000) % 40, seed=1)
+    keys = rank_batch(states)
+    assert np.array_equal(unrank_batch(keys), states)
+    assert np.array_equal(unrank(rank(newstate())), newstate())
+    for state in states[:50]:
+        assert np.array_equal(unrank(rank(state)), state)
+
+
+def test_rank_range():
+    'The keys are within their ranges and rank combines them'
+    states, _ = scramble(2000, 30, seed=2)
+    keys = rank_batch(states)
+    assert np.all(keys[:,0] < n_cornerkeys) and np.all(keys[:,1] < n_edgekeys)
+    for state, (ckey, ekey) in zip(states[:50], keys[:50]):
+        assert rank(state) == int(ckey) * n_edgekeys + int(ekey)
+
+
+def test_unrank_roundtrip():
+    'Random keys (including the extreme ones) give legal states with the same keys, i. e. rank is a bijection'
+    rng = np.random.default_rng(3)
+    keys = np.stack([ rng.integers(0, n_cornerkeys, 2000), rng.integers(0, n_edgekeys, 2000) ], axis=1).astype('uint64')
+    keys[0] = (0, 0)
+    keys[1] = (n_cornerkeys - 1, n_edgekeys - 1)
+    states = unrank_batch(keys)
+    assert np.array_equal(rank_batch(states), keys)
+    # legal states: all pieces present, twist of the corners 0 mod 3, flip of the edges even
+    assert np.all(np.sort(states[:,:8] % 8, 1) == np.arange(8))
+    assert np.all(np.sort(states[:,8:] % 12, 1) == np.arange(12))
+    assert np.all(np.sum((states[:,:8] // 8) * _chirality, 1) % 3 == 0)
+    assert np.all(np.sum(states[:,8:] // 12, 1) % 2 == 0)
+    assert all( _rank_perm(s[:8] % 8)[1] == _rank_perm(s[8:] % 12)[1] for s in states ) # same parity
+
+
+def test_rank_unique():
+    'Different states have different keys'
+    states, _ = scramble(5000, np.arange(5000) % 12, seed=4)
+    states = np.unique(states, axis=0)
+    keys = rank_batch(states)
+    assert len(np.unique(keys, axis=0)) == len(states)
+
+
+def test_symmetries_match_cube():
+    'Each of the 48 symmetries equals rotating (and mirroring) a RubiksCube followed by the color normalization'
+    symmetries = cube_rotations()
+    symmetries += [ ms + 'i' for ms in symmetries ]
+    assert len(symmetries) == num_symmetries
+    states, _ = scramble(5, 20, seed=5)
+    cube = RubiksCube()
+    for s, ms in enumerate(symmetries):
+        images = apply_symmetry(states, s)
+        for state, image in zip(states, images):
+            cube.frompieces(state)
+            cube.rotate(ms)
+            cube.colornormalization()
+            assert np.array_equal(cube.getpieces(), image)
+
+
+def test_symmetries_legal():
+    'The images of legal states are legal (rank round trip), the identity is symmetry 0'
+    states, _ = scramble(500, 25, seed=6)
+    assert np.array_equal(apply_symmetry(states, 0), states)
+    for s in range(num_symmetries):
+        images = apply_symmetry(states, s)
+        assert np.array_equal(unrank_batch(rank_batch(images)), images)
+
+
+def test_symmetries_neighbours():
+    'A symmetry maps the 12 neighbours of a state onto the 12 neighbours of its image'
+    states, _ = scramble(50, 15, seed=7)
+    neighbours = apply_all_moves(states) # (b, 12, 20)
+    for s in range(num_symmetries):
+        images = apply_all_moves(apply_symmetry(states, s))
+        mapped = apply_symmetry(neighbours.reshape(-1, 20), s).reshape(images.shape)
+        for a, b in zip(mapped, images):
+            assert set(map(bytes, a)) == set(map(bytes, b))
+
+
+def test_canonicalize():
+    'canonicalize is invariant under all symmetries and returns the applied symmetry'
+    states, _ = scramble(200, 20, seed=8)
+    canonical, syms = canonicalize(states, return_symmetries=True)
+    assert np.array_equal(apply_symmetry(states, syms), canonical)
+    for s in range(num_symmetries):
+        assert np.array_equal(canonicalize(apply_symmetry(states, s)), canonical)
+
+
+if __name__ == '__main__':
+    for name, f in list(globals().items()):
+        if name.startswith('test_'):
+            f()
+            print(name, 'ok')
@@ -0,0 +1,141 @@
+'''
+Checks of the solver and its open list (hash table, lazy heaps, parent pointers and eviction), with a cheap heuristic
+instead of a network. Run with pytest or python test_solver.py
+'''
+
+import numpy as np
+from rubiks_solver import *
+from rubiks_helpers import OpenList
+
+
+def heuristic(states):
+    'Misplaced pieces, a cheap and deterministic heuristic'
+    return (0.7 * np.sum(states != newstate(), 1)).astype('float32')
+
+
+def scrambles(n, seed):
+    states, _ = scramble(n, np.arange(n) % 6 + 3, seed=seed, no_repeat=True)
+    return states
+
+
+def check_solutions(states, results):
+    for state, res in zip(states, results):
+        if res['solved']:
+            assert res['l'] == len(res['ms'])
+            assert issolved(apply(state, res['ms']))
+
+
+def test_solutions():
+    'Every returned move sequence solves its cube'
+    states = scrambles(12, seed=1)
+    results = Solver(heuristic, maxlen=30, trials=2000).solve_many(states)
+    assert sum(res['solved'] for res in results) >= 6
+    check_solutions(states, results)
+
+
+def test_solve_many_equals_solve():
+    'solve_many gives the same results as solving the cubes one by one'
+    states = scrambles(8, seed=2)
+    solver = Solver(heuristic, maxlen=30, trials=1000, max_nodes=3000)
+    many = solver.solve_many(states)
+    for state, res in zip(states, many):
+        single = solver.solve(state)
+        for key in ('solved', 'ms', 'l', 'trials', 'nodes', 'evicted'):
+            assert single[key] == res[key], key
+
+
+def test_memory_budget():
+    'With a budget the solutions stay valid, the open list stays bounded and nodes are evicted'
+    states = scrambles(8, seed=3)
+    free = Solver(heuristic, maxlen=30, trials=3000).solve_many(states)
+    bounded = Solver(heuristic, maxlen=30, trials=3000, max_nodes=2000).solve_many(states)
+    check_solutions(states, bounded)
+    assert sum(res['evicted'] for res in bounded) > 0
+    assert max(res['memory'] for res in bounded) < max(res['memory'] for res in free)
+
+
+def check_open_list(queue, root):
+    'Invariants of the open list: parents, moves, hash table and heaps'
+    n = queue.n
+    assert queue.parent[0] == -1
+    parents = queue.parent[1:n]
+    assert np.all(parents >= 0) and np.all(parents < np.arange(1, n))
+    # the state of each node is the state of its parent after its move
+    states = unrank_batch(queue.keys(np.arange(n)))
+    assert np.array_equal(states[0], root)
+    assert np.array_equal(apply_batch(states[parents], queue.move[1:n]), states[1:])
+    # every state once, all of them found by the hash table
+    assert len(np.unique(queue.keys(np.arange(n)), axis=0)) == n
+    assert all( tuple(key) in queue for key in queue.keys(np.arange(n)) )
+    # the heaps hold all open nodes, each once
+    is_open = np.flatnonzero(~queue.closed[:n])
+    assert len(queue) == len(is_open)
+    for q in range(queue.nq):
+        heap = queue.heaps[q, :queue.sizes[q]]
+        assert np.array_equal(np.unique(heap[~queue.closed[heap]]), is_open)
+
+
+def test_open_list_evict():
+    'Eviction keeps the parent indices valid, the number of nodes bounded and the invariants of the open list'
+    root = scramble(1, 12, seed=4)[0][0]
+    queue = OpenList(capacity=16)
+    queue.push(rank_batch(root[None]), parents=[-1], moves=[-1], g=[0], h=heuristic(root[None]))
+    max_nodes, batchsize, total = 1500, 10, 0
+    for step in range(400):
+        nodes = queue.pop(step % queue.nq, batchsize)
+        if len(nodes) == 0:
+            break
+        children = apply_all_moves(unrank_batch(queue.keys(nodes))).reshape(-1, 20)
+        parents = np.repeat(nodes, 12)
+        queue.push(rank_batch(children), parents, np.tile(np.arange(12), len(nodes)), queue.g[parents] + 1,
+                   heuristic(children))
+        assert queue.n <= max_nodes + 12*batchsize
+        if queue.n > max_nodes:
+            n = queue.n
+            evicted = queue.evict(n - int(0.8*max_nodes))
+            total += len(evicted)
+            assert np.all(np.diff(evicted) > 0) and queue.n == n - len(evicted)
+            assert tuple(rank_batch(root[None])[0]) in queue
+            check_open_list(queue, root)
+        if step % 50 == 0:
+            check_open_list(queue, root)
+    assert total > 0
+    check_open_list(queue, root)
+
+
+def test_open_list_order():
+    'Each queue pops its nodes in the order of h + penalty*t*g (ties by insertion), the duplicates are dropped'
+    rng = np.random.default_rng(5)
+    states, _ = scramble(300, 8, seed=5)
+    keys = rank_batch(states)
+    g, h = rng.integers(0, 10, 300), rng.integers(0, 10, 300).astype('float32')
+    for q in range(5):
+        queue = OpenList()
+        nodes, new = queue.push(keys, -np.ones(300), -np.ones(300), g, h)
+        assert len(queue.push(keys[:10], -np.ones(10), -np.ones(10), g[:10], h[:10])[0]) == 0
+        popped = np.concatenate([ queue.pop(q, 1) for _ in range(len(queue)) ])
+        priority = h[new] + queue.t[q] * g[new]
+        assert np.array_equal(popped, np.lexsort((nodes, priority)))
+
+
+def test_accumulators():
+    'The incremental evaluation of the children by the accumulators gives the same search as the plain evaluation'
+    import torch
+    from net import Net
+    torch.manual_seed(0)
+    net = Net().eval()
+    states = scrambles(3, seed=6)
+    kwargs = dict(maxlen=30, trials=40, max_nodes=300)
+    plain = Solver(NetHeuristic(net), **kwargs).solve_many(states)
+    acc = Solver(NetHeuristic(net, accumulators=True), acc_cache=100, **kwargs).solve_many(states)
+    assert sum(res['evicted'] for res in acc) > 0
+    for a, b in zip(plain, acc):
+        for key in ('solved', 'ms', 'trials', 'nodes', 'evicted'):
+            assert a[key] == b[key], key
+
+
+if __name__ == '__main__':
+    for name, f in list(globals().items()):
+        if name.startswith('test_'):
+            f()
+            print(name, 'ok')